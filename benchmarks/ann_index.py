@@ -0,0 +1,51 @@
+import argparse
+import time
+
+import numpy
+
+from genevector.index import VectorIndex, benchmark
+from genevector.vectors import read_vectors
+
+
+def report(name, index, queries, k):
+    print(name)
+    for row in benchmark(index, queries, k=k):
+        print("  nprobe={nprobe:<6} recall@{k}={recall:.3f}  {ms:.3f} ms/query".format(k=k, ms=row["latency"] * 1000, **row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall and latency of the IVF index against exact search.")
+    parser.add_argument("--vectors", help="gene embedding written by GeneVector (genes.vec)")
+    parser.add_argument("--genes", type=int, default=20000)
+    parser.add_argument("--cells", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(args.seed)
+    if args.vectors:
+        _, matrix = read_vectors(args.vectors)
+        genes = numpy.asarray(matrix)
+    else:
+        # Trained gene embeddings are clustered (metagenes), not isotropic.
+        centers = rng.standard_normal((200, args.dim)).astype(numpy.float32)
+        genes = centers[rng.integers(0, len(centers), args.genes)]
+        genes += 0.5 * rng.standard_normal(genes.shape).astype(numpy.float32)
+
+    # Cells are expression-weighted mixtures of gene vectors, as in CellEmbedding.
+    programs = genes[rng.choice(len(genes), (64, 20))].mean(axis=1)
+    cells = programs[rng.integers(0, len(programs), args.cells)]
+    cells += 0.5 * rng.standard_normal(cells.shape).astype(numpy.float32) * cells.std()
+
+    for name, matrix in (("genes", genes), ("cells", cells)):
+        start = time.time()
+        index = VectorIndex.build(matrix, seed=args.seed)
+        print("{}: {} vectors, {} lists, built in {:.1f}s".format(name, len(matrix), len(index.centroids), time.time() - start))
+        queries = matrix[rng.choice(len(matrix), args.queries, replace=False)]
+        report(name, index, queries, args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy
+import scanpy as sc
+import torch
+
+from genevector.data import GeneVectorDataset
+from genevector.model import GeneVector
+from genevector import distributed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Epoch time of distributed CPU training by number of processes.")
+    parser.add_argument("h5ad")
+    parser.add_argument("--nprocs", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--dim", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = GeneVectorDataset(sc.read(args.h5ad))
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = os.path.join(tmp, "cache")
+        for i, nprocs in enumerate(args.nprocs):
+            numpy.random.seed(args.seed)
+            torch.manual_seed(args.seed)
+            gene_vector = GeneVector(dataset, os.path.join(tmp, "genes.vec"), emb_dimension=args.dim,
+                                     batch_size=args.batch_size, threshold=-1, cache=cache)
+            start = time.time()
+            distributed.train(gene_vector, args.epochs, nprocs=nprocs, master_port=29500 + i)
+            elapsed = (time.time() - start) / args.epochs
+            baseline = baseline or elapsed
+            print("{:>3} processes: {:.3f}s/epoch, speedup {:.2f}x".format(nprocs, elapsed, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import argparse
+import copy
+import os
+import tempfile
+
+import scanpy as sc
+import torch
+
+from genevector.data import GeneVectorDataset
+from rankings import train, query_genes, compare
+
+
+def footprint(model):
+    # Bytes per (i, j, x_ij) triplet, and of the embedding tables plus
+    # optimizer state.
+    dataset = model.dataset
+    triplet_bytes = sum(t.element_size() for t in (dataset._xij, dataset._i_idx, dataset._j_idx))
+    tensors = list(model.model.parameters())
+    if hasattr(model.optimizer, "state_sums"):
+        tensors += model.optimizer.state_sums
+    else:
+        tensors += [v for state in model.optimizer.state.values() for v in state.values() if torch.is_tensor(v)]
+    return triplet_bytes, sum(t.numel() * t.element_size() for t in tensors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and similarity rankings of low-precision training.")
+    parser.add_argument("h5ad")
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--dim", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=100000)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = GeneVectorDataset(sc.read(args.h5ad))
+    configs = [("float32", dict()),
+               ("int32 + bf16 targets", dict(index_dtype="int32", target_dtype="bfloat16")),
+               ("+ bf16 tables", dict(index_dtype="int32", target_dtype="bfloat16", embedding_dtype="bfloat16")),
+               ("+ fp16 tables", dict(index_dtype="int32", target_dtype="float16", embedding_dtype="float16"))]
+    with tempfile.TemporaryDirectory() as tmp:
+        results = []
+        for i, (name, options) in enumerate(configs):
+            model, embed, _ = train(copy.copy(dataset), os.path.join(tmp, "genes{}.vec".format(i)), args,
+                                    threshold=-1, seed=args.seed, **options)
+            results.append((embed,) + footprint(model))
+        reference = results[0][0]
+        genes = query_genes(reference, args.queries, seed=args.seed)
+        for (name, _), (embed, triplet_bytes, table_bytes) in zip(configs, results):
+            overlap, rho = compare(reference, embed, genes, args.k)
+            print("{:<24} {:>3} bytes/triplet, tables {:.2f} MB, top-{} overlap {:.3f}, spearman {:.3f}".format(
+                name, triplet_bytes, table_bytes / 1e6, args.k, overlap, rho))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import time
+
+import numpy
+import torch
+from scipy import stats
+
+from genevector.model import GeneVector
+from genevector.embedding import GeneEmbedding
+
+
+def train(dataset, output_file, args, **options):
+    # Trains args.epochs epochs with the shared --dim/--batch-size/--lr/--seed
+    # arguments; returns the model, its average-vector embedding and the
+    # seconds per epoch.
+    torch.manual_seed(args.seed)
+    numpy.random.seed(args.seed)
+    model = GeneVector(dataset,
+                       output_file=output_file,
+                       emb_dimension=args.dim,
+                       batch_size=args.batch_size,
+                       initial_lr=args.lr,
+                       **options)
+    start = time.time()
+    model.train(args.epochs)
+    elapsed = (time.time() - start) / args.epochs
+    return model, GeneEmbedding(output_file, dataset, vector="average"), elapsed
+
+
+def query_genes(embedding, n, seed=0):
+    rng = numpy.random.RandomState(seed)
+    return rng.choice(embedding.genes, min(n, len(embedding.genes)), replace=False)
+
+
+def compare(reference, other, genes, k):
+    # Mean top-k neighbour overlap and mean Spearman correlation of the full
+    # similarity rankings of other against reference over the query genes.
+    overlaps = []
+    correlations = []
+    for gene in genes:
+        a = reference.compute_similarities(gene)
+        b = other.compute_similarities(gene)
+        overlaps.append(len(set(a["Gene"][1:k+1]) & set(b["Gene"][1:k+1])) / k)
+        b = b.set_index("Gene").loc[a["Gene"]]
+        correlations.append(stats.spearmanr(a["Similarity"], b["Similarity"])[0])
+    return numpy.mean(overlaps), numpy.mean(correlations)
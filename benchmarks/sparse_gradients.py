@@ -0,0 +1,48 @@
+import argparse
+import time
+
+import torch
+
+from genevector.model import GeneVectorModel, build_optimizer, mse_loss
+
+
+def step_time(n_genes, args, sparse, optimizer):
+    torch.manual_seed(args.seed)
+    model = GeneVectorModel(n_genes, args.dim, sparse=sparse, bias=args.bias)
+    optimizer = build_optimizer(model, optimizer, args.lr)
+    batches = [(torch.randint(n_genes, (args.batch_size,)),
+                torch.randint(n_genes, (args.batch_size,)),
+                torch.rand(args.batch_size)) for _ in range(args.steps + 1)]
+    for step, (i_idx, j_idx, x_ij) in enumerate(batches):
+        if step == 1:
+            # The first step allocates optimizer state; leave it out.
+            start = time.time()
+        optimizer.zero_grad(set_to_none=True)
+        loss = mse_loss(model(i_idx, j_idx), x_ij)
+        loss.backward()
+        optimizer.step()
+    return (time.time() - start) / args.steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-step time of dense vs sparse embedding gradients.")
+    parser.add_argument("--genes", type=int, nargs="+", default=[5000, 20000, 60000])
+    parser.add_argument("--dim", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--bias", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    modes = [("dense adagrad", False, "adagrad"), ("sparse adagrad", True, "adagrad"), ("sparse adam", True, "sparse_adam")]
+    print("{:>8} {:>10} ".format("genes", "unique") + " ".join("{:>16}".format(name) for name, _, _ in modes))
+    for n_genes in args.genes:
+        torch.manual_seed(args.seed)
+        unique = len(torch.unique(torch.cat([torch.randint(n_genes, (args.batch_size,)) for _ in range(2)])))
+        times = [step_time(n_genes, args, sparse, optimizer) for _, sparse, optimizer in modes]
+        print("{:>8} {:>10} ".format(n_genes, unique) + " ".join("{:>13.2f} ms".format(t * 1000) for t in times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import argparse
+import copy
+
+import scanpy as sc
+
+from genevector.data import GeneVectorDataset
+from rankings import train, query_genes, compare
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-pair vs sparse-target training.")
+    parser.add_argument("h5ad")
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--dim", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=100000)
+    parser.add_argument("--lr", type=float, default=0.1)
+    parser.add_argument("--negatives", type=int, default=None)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    adata = sc.read(args.h5ad)
+    dataset = GeneVectorDataset(adata)
+    full_model, full, full_time = train(copy.copy(dataset), "full.vec", args, threshold=0.0, sparse=False,
+                                        negatives=args.negatives)
+    sparse_model, sparse, sparse_time = train(copy.copy(dataset), "sparse.vec", args, threshold=0.0, sparse=True,
+                                              negatives=args.negatives)
+    full_data, sparse_data = full_model.dataset, sparse_model.dataset
+
+    genes = query_genes(full, args.queries, seed=args.seed)
+    overlap, rho = compare(full, sparse, genes, args.k)
+    print("full:   {} pairs, {:.3f}s/epoch".format(len(full_data._xij), full_time))
+    print("sparse: {} pairs (+{} negatives), {:.3f}s/epoch".format(len(sparse_data._xij), sparse_data.negatives, sparse_time))
+    print("top-{} neighbour overlap: {:.3f}".format(args.k, overlap))
+    print("mean spearman of similarity rankings: {:.3f}".format(rho))
+
+
+if __name__ == "__main__":
+    main()
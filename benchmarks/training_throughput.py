@@ -0,0 +1,90 @@
+import argparse
+import os
+import tempfile
+import time
+
+import anndata
+import numpy
+import scipy.sparse
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from genevector.data import GeneVectorDataset
+from genevector.model import GeneVector, GeneVectorModel
+
+
+def synthetic(n_cells, n_genes, density, seed):
+    rng = numpy.random.default_rng(seed)
+    X = scipy.sparse.random(n_cells, n_genes, density=density, format="csr", random_state=seed,
+                            data_rvs=lambda n: rng.poisson(3, n) + 1).astype(numpy.float32)
+    adata = anndata.AnnData(X)
+    adata.obs.index = ["cell{}".format(i) for i in range(n_cells)]
+    adata.var.index = ["G{}".format(i) for i in range(n_genes)]
+    return adata
+
+
+def legacy_epoch(dataset, model, optimizer, batch_size):
+    # The training loop before the throughput changes: host permutation,
+    # per-step device moves in the loss and a loss.item() sync every batch.
+    xij, i_idx, j_idx = dataset._xij, dataset._i_idx, dataset._j_idx
+    rand_ids = torch.LongTensor(numpy.random.choice(len(xij), len(xij), replace=False))
+    loss_values = []
+    for p in range(0, len(rand_ids), batch_size):
+        batch_ids = rand_ids[p:p+batch_size]
+        optimizer.zero_grad()
+        outputs = model(i_idx[batch_ids], j_idx[batch_ids])
+        loss = torch.mean(F.mse_loss(outputs, xij[batch_ids], reduction="none")).to("cpu")
+        loss.backward()
+        optimizer.step()
+        loss_values.append(loss.item())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Training samples/sec on CPU before and after the throughput changes.")
+    parser.add_argument("--h5ad", default=None)
+    parser.add_argument("--cells", type=int, default=2000)
+    parser.add_argument("--genes", type=int, default=1000)
+    parser.add_argument("--density", type=float, default=0.1)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--dim", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=100000)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    adata = anndata.read_h5ad(args.h5ad) if args.h5ad else synthetic(args.cells, args.genes, args.density, args.seed)
+    dataset = GeneVectorDataset(adata)
+    dataset.create_inputs_outputs()
+    n_samples = len(dataset._xij)
+    print("{} genes, {} samples per epoch".format(len(dataset.data.gene2id), n_samples))
+
+    torch.manual_seed(args.seed)
+    numpy.random.seed(args.seed)
+    model = GeneVectorModel(len(dataset.data.gene2id), args.dim)
+    optimizer = optim.Adagrad(model.parameters(), lr=0.01)
+    start = time.time()
+    for _ in range(args.epochs):
+        legacy_epoch(dataset, model, optimizer, args.batch_size)
+    before = n_samples * args.epochs / (time.time() - start)
+    print("before:           {:,.0f} samples/sec".format(before))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for compile in (False, True):
+            torch.manual_seed(args.seed)
+            trainer = GeneVector(dataset, os.path.join(tmp, "genes.vec"), emb_dimension=args.dim,
+                                 batch_size=args.batch_size, threshold=-1, compile=compile)
+            if compile:
+                # Compilation happens on the first batches; keep it out of the timing.
+                trainer.train(1)
+            start = time.time()
+            trainer.train(args.epochs)
+            after = n_samples * args.epochs / (time.time() - start)
+            label = "after (compiled):" if compile else "after:           "
+            print("{} {:,.0f} samples/sec ({:.2f}x)".format(label, after, after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import hashlib
+import os
+import time
+
+import numpy
+
+from genevector.storage import write_directory, read_array, read_entry, remove
+
+CACHE_VERSION = 1
+
+
+def fingerprint(context, **params):
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update("genevector-inputs-v{}".format(CACHE_VERSION).encode("utf-8"))
+    matrix = context.matrix
+    digest.update(numpy.asarray(matrix.shape, dtype=numpy.int64).tobytes())
+    for array in (matrix.indptr, matrix.indices, matrix.data):
+        digest.update(numpy.ascontiguousarray(array).view(numpy.uint8))
+    digest.update("\n".join(context.genes).encode("utf-8"))
+    digest.update(repr(context.frequency_lower_bound).encode("utf-8"))
+    for key in sorted(params):
+        digest.update("{}={!r}".format(key, params[key]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class InputCache(object):
+    # Content-addressed store of create_inputs_outputs results. Each entry is
+    # a directory of .npy files named by the dataset fingerprint; entries are
+    # evicted least recently used first once max_size bytes is exceeded, and
+    # results larger than max_size are not stored.
+
+    def __init__(self, path, max_size=10 * 1024 ** 3):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry(self, key):
+        return os.path.join(self.path, key)
+
+    def __contains__(self, key):
+        return os.path.isdir(self.entry(key))
+
+    def load(self, key, mmap_mode=None):
+        if key not in self:
+            return None
+        arrays = read_entry(self.entry(key), lambda entry: self.read_arrays(entry, mmap_mode))
+        now = time.time()
+        os.utime(self.entry(key), (now, now))
+        return arrays
+
+    def read_arrays(self, entry, mmap_mode):
+        return {name[:-4]: read_array(entry, name[:-4], mmap_mode=mmap_mode)
+                for name in os.listdir(entry) if name.endswith(".npy")}
+
+    def save(self, key, arrays):
+        # evict() never removes the entry just written, so one larger than
+        # max_size would stay regardless of the limit.
+        size = sum(numpy.asarray(array).nbytes for array in arrays.values())
+        if size > self.max_size:
+            print("Not caching inputs {} ({:.1f} GB > max_size {:.1f} GB).".format(key, size / 1024 ** 3, self.max_size / 1024 ** 3))
+            return
+        write_directory(self.entry(key), arrays)
+        self.evict(keep=key)
+
+    def size(self, key):
+        entry = self.entry(key)
+        return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+    def entries(self):
+        keys = [key for key in os.listdir(self.path) if not key.startswith(".") and key in self]
+        return sorted(keys, key=lambda key: os.path.getmtime(self.entry(key)))
+
+    def evict(self, keep=None):
+        keys = self.entries()
+        total = sum(self.size(key) for key in keys)
+        for key in keys:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total -= self.size(key)
+            remove(self.entry(key))
+
+    def clear(self):
+        for key in self.entries():
+            remove(self.entry(key))
@@ -3,7 +3,7 @@ import torch
 from torch.utils.data import Dataset
 import scanpy as sc
 import numpy
-from scipy.sparse import csr_matrix, find
+from scipy.sparse import csr_matrix, csc_matrix, find
 import operator
 import itertools
 from itertools import permutations
@@ -12,8 +12,12 @@ import tqdm
 import random
 import pickle
 import collections
+import collections.abc
 import sys
 import os
+import shutil
+import tempfile
+import multiprocessing
 from sklearn.preprocessing import MinMaxScaler
 import matplotlib.pyplot as plt
 from collections import Counter
@@ -23,6 +27,7 @@ import gc
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy
+import scipy.spatial
 import pandas
 from sklearn import feature_extraction
 import copy
@@ -31,6 +36,11 @@ import tqdm
 import statsmodels.api as sm
 from scipy.stats import nbinom
 
+from genevector.cache import InputCache, fingerprint
+from genevector.storage import write_directory, read_header, read_array, read_entry
+
+CONTEXT_VERSION = 1
+
 class Context(object):
 
     def __init__(self):
@@ -59,11 +69,12 @@ class Context(object):
             pass
         context.cells = context.adata.obs.index
         context.cell_index, context.index_cell = Context.index_cells(context.cells)
-        context.data, context.cell_to_gene = context.expression(context.normalized_matrix, \
-                            context.genes, \
-                            context.index_cell,
-                            expression=expression)
-        context.expressed_genes = context.get_expressed_genes(context.data)
+        print("Loading Expression.")
+        if expression == None:
+            context.matrix = Context.positive_matrix(context.normalized_matrix)
+        else:
+            context.matrix = context.matrix_from_expression(pickle.load(open(expression,"rb")))
+        context.filter_on_frequency()
         context.gene_index, context.index_gene = Context.index_geneset(context.expressed_genes)
         context.gene2id = context.gene_index
         context.id2gene = context.index_gene
@@ -72,11 +83,15 @@ class Context(object):
         return context
 
     @classmethod
-    def load(context_class, path):
+    def load(context_class, path, mmap_mode="r"):
         context = context_class()
-        serialized = pickle.load(open(path, "rb"))
-        context.unserialize(serialized)
-        context.path = os.path.split(path)[0]
+        if os.path.isdir(path):
+            context.read(path, mmap_mode=mmap_mode)
+            context.path = path
+        else:
+            serialized = pickle.load(open(path, "rb"))
+            context.unserialize(serialized)
+            context.path = os.path.split(path)[0]
         return context
 
     @staticmethod
@@ -91,185 +106,622 @@ class Context(object):
         index_cell = {idx: w for (idx, w) in enumerate(cells)}
         return cell_index, index_cell
 
+    @staticmethod
+    def positive_matrix(matrix):
+        matrix = csr_matrix(matrix)
+        if (matrix.data <= 0).any() or not matrix.has_sorted_indices:
+            matrix = matrix.copy()
+            matrix.data[matrix.data < 0] = 0
+            matrix.eliminate_zeros()
+            matrix.sort_indices()
+        return matrix
+
+    def matrix_from_expression(self, expression):
+        gene_index, _ = Context.index_geneset(self.genes)
+        rows, cols, vals = [], [], []
+        for cell, genes in expression.items():
+            for gene, val in genes.items():
+                if gene in gene_index:
+                    rows.append(self.cell_index[cell])
+                    cols.append(gene_index[gene])
+                    vals.append(val)
+        matrix = csr_matrix((vals, (rows, cols)), shape=(len(self.cells), len(self.genes)), dtype=numpy.float32)
+        return Context.positive_matrix(matrix)
+
+    def filter_on_frequency(self):
+        frequency = self.matrix.getnnz(axis=0)
+        self.expressed_mask = frequency >= self.frequency_lower_bound
+        self.expressed_columns = numpy.flatnonzero(self.expressed_mask)
+        self.expressed_genes = [self.genes[i] for i in self.expressed_columns]
+        self.gene_frequency = collections.defaultdict(int, zip(self.expressed_genes, frequency[self.expressed_columns].tolist()))
+
+    @property
+    def csc(self):
+        if getattr(self, "_csc", None) is None:
+            self._csc = self.matrix.tocsc()
+        return self._csc
+
+    @property
+    def expression(self):
+        return _CellExpressionView(self)
+
+    @property
+    def data(self):
+        return _GeneCellsView(self)
+
+    @property
+    def cell_to_gene(self):
+        return _CellGenesView(self)
+
     def get_expressed_genes(self, data):
         return list(data.keys())
 
     def get_expressed_genes_frequency(self, data):
         return self.gene_frequency
 
-    def inverse_filter(self, data):
-        cell_to_gene = collections.defaultdict(list)
-        for gene, cells in data.items():
-            for cell in cells:
-                cell_to_gene[cell].append(gene)
-        return cell_to_gene
-
-    def expression(self, normalized_matrix, genes, cells, expression=None):
-        gene_index, index_gene = Context.index_geneset(genes)
-        self.gene_frequency = collections.defaultdict(int)
-        data = collections.defaultdict(list)
-        if expression == None:
-            self.expression = collections.defaultdict(dict)
-            nonzero = find(normalized_matrix > 0)
-            print("Loading Expression.")
-
-            nonindexed_expression = collections.defaultdict(dict)
-            for cell, gene_i, val in tqdm.tqdm(list(zip(*nonzero))):
-                symbol = index_gene[gene_i]
-                nonindexed_expression[cell][symbol] = normalized_matrix[cell,gene_i]
-
-            print("Reindexing Cooc")
-            for cell, genes in tqdm.tqdm(list(nonindexed_expression.items())):
-                barcode = cells[cell]
-                for index, val in genes.items():
-                    self.expression[barcode][index] = val
-                    data[index].append(barcode)
-                    self.gene_frequency[index] += 1
-        else:
-            self.expression = pickle.load(open(expression,"rb"))
-            for cell, genes in tqdm.tqdm(list(self.expression.items())):
-                for gene, val in genes.items():
-                    data[gene].append(cell)
-                    self.gene_frequency[gene] += 1
-
-        data = self.filter_on_frequency(data)
-        return data, self.inverse_filter(data)
-
-    def filter_on_frequency(self, data):
-        remove = []
-        for gene, frequency in self.gene_frequency.items():
-            if frequency < self.frequency_lower_bound:
-                del data[gene]
-                remove.append(gene)
-        for gene in remove:
-            del self.gene_frequency[gene]
-        return data
-
     def serialize(self):
         serialized = dict()
         for attr, value in self.__dict__.items():
-            if attr != "adata" and attr != "inv_data" and attr != "data":
+            if attr != "adata" and attr != "inv_data" and attr != "_csc":
                 serialized[attr] = value
         return serialized
 
     def unserialize(self, serialized):
+        legacy = serialized.pop("expression", None)
+        for attr in ("data", "cell_to_gene"):
+            serialized.pop(attr, None)
         for attribute, value in serialized.items():
             setattr(self, attribute, value)
-
-    def save(self, filename):
-        serialized = self.serialize()
-        pickle.dump(serialized, open(filename,"wb"))
+        if legacy is not None:
+            self.matrix = self.matrix_from_expression(legacy)
+            if not hasattr(self, "expressed_mask"):
+                expressed = set(self.gene_frequency.keys())
+                self.expressed_mask = numpy.array([gene in expressed for gene in self.genes])
+                self.expressed_columns = numpy.flatnonzero(self.expressed_mask)
+
+    def save(self, path):
+        # Versioned directory of .npy arrays plus a small JSON header, so
+        # load() can memory-map the expression matrix instead of unpickling.
+        arrays = {"indptr": self.matrix.indptr,
+                  "indices": self.matrix.indices,
+                  "data": self.matrix.data,
+                  "genes": numpy.array(self.genes, dtype=str),
+                  "cells": numpy.array(self.cells, dtype=str),
+                  "frequency": self.matrix.getnnz(axis=0),
+                  "expressed_columns": self.expressed_columns,
+                  "expressed_genes": numpy.array(self.expressed_genes, dtype=str)}
+        header = {"format": "genevector.context",
+                  "version": CONTEXT_VERSION,
+                  "shape": list(self.matrix.shape),
+                  "frequency_lower_bound": self.frequency_lower_bound,
+                  "threads": self.threads}
+        write_metadata = lambda staging: self.metadata.to_pickle(os.path.join(staging, "metadata.pkl"))
+        write_directory(path, arrays, header_file="context.json", header=header, write=write_metadata)
+
+    def read(self, path, mmap_mode="r"):
+        read_entry(path, lambda version: self.read_version(version, mmap_mode))
+
+    def read_version(self, path, mmap_mode):
+        header = read_header(path, "context.json", "genevector.context", CONTEXT_VERSION)
+        load = lambda name: read_array(path, name, mmap_mode=mmap_mode)
+        self.frequency_lower_bound = header["frequency_lower_bound"]
+        self.threads = header["threads"]
+        self.genes = load("genes").tolist()
+        self.cells = pandas.Index(load("cells"))
+        self.cell_index, self.index_cell = Context.index_cells(self.cells)
+        self.matrix = csr_matrix((load("data"), load("indices"), load("indptr")), shape=tuple(header["shape"]))
+        self.normalized_matrix = self.matrix
+        self.metadata = pandas.read_pickle(os.path.join(path, "metadata.pkl"))
+        frequency = load("frequency")
+        self.expressed_columns = numpy.asarray(load("expressed_columns"))
+        self.expressed_mask = numpy.zeros(len(self.genes), dtype=bool)
+        self.expressed_mask[self.expressed_columns] = True
+        filtered = [self.genes[i] for i in self.expressed_columns]
+        self.gene_frequency = collections.defaultdict(int, zip(filtered, frequency[self.expressed_columns].tolist()))
+        self.gene_index, self.index_gene = Context.index_geneset(filtered)
+        self.expressed_genes = load("expressed_genes").tolist()
+        self.gene2id, self.id2gene = Context.index_geneset(self.expressed_genes)
+        self.gene_count = len(self.gene_frequency)
 
     def frequency(self, gene):
         return self.gene_frequency[gene] / len(self.cells)
 
+    def expression_matrix(self, genes=None):
+        if genes is None:
+            return self.csc[:, self.expressed_columns]
+        gene_index, _ = Context.index_geneset(self.genes)
+        return self.csc[:, [gene_index[gene] for gene in genes]]
+
+
+class _CellExpressionView(collections.abc.Mapping):
+
+    def __init__(self, context):
+        self.context = context
+        self.cells = numpy.flatnonzero(context.matrix.getnnz(axis=1))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __iter__(self):
+        for cell in self.cells:
+            yield self.context.index_cell[cell]
+
+    def __getitem__(self, barcode):
+        matrix = self.context.matrix
+        cell = self.context.cell_index[barcode]
+        start, end = matrix.indptr[cell], matrix.indptr[cell + 1]
+        genes = self.context.genes
+        return dict(zip([genes[i] for i in matrix.indices[start:end]], matrix.data[start:end].tolist()))
+
+
+class _GeneCellsView(collections.abc.Mapping):
+
+    def __init__(self, context):
+        self.context = context
+        self.gene_index, _ = Context.index_geneset(context.genes)
+
+    def __len__(self):
+        return len(self.context.expressed_columns)
+
+    def __iter__(self):
+        for gene in self.context.expressed_columns:
+            yield self.context.genes[gene]
+
+    def __getitem__(self, gene):
+        column = self.gene_index[gene]
+        if not self.context.expressed_mask[column]:
+            raise KeyError(gene)
+        csc = self.context.csc
+        cells = self.context.cells
+        return list(cells[csc.indices[csc.indptr[column]:csc.indptr[column + 1]]])
+
+
+class _CellGenesView(collections.abc.Mapping):
+
+    def __init__(self, context):
+        self.context = context
+        self.matrix = context.matrix[:, context.expressed_columns]
+        self.cells = numpy.flatnonzero(self.matrix.getnnz(axis=1))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __iter__(self):
+        for cell in self.cells:
+            yield self.context.index_cell[cell]
+
+    def __getitem__(self, barcode):
+        cell = self.context.cell_index[barcode]
+        start, end = self.matrix.indptr[cell], self.matrix.indptr[cell + 1]
+        genes, columns = self.context.genes, self.context.expressed_columns
+        return [genes[columns[i]] for i in self.matrix.indices[start:end]]
+
+
+class PairMatrix(object):
+    # Gene x gene scores addressed as pairs[gene][cgene]. Backed either by a
+    # square matrix or by a condensed upper-triangular vector with an
+    # implicit zero diagonal.
+
+    def __init__(self, values, genes):
+        self.values = values
+        self.genes = list(genes)
+        self.gene_index, _ = Context.index_geneset(self.genes)
+
+    def __len__(self):
+        return len(self.genes)
+
+    def __contains__(self, gene):
+        return gene in self.gene_index
+
+    def __getitem__(self, gene):
+        return _PairRow(self, self.gene_index.get(gene))
+
+    def index(self, i, j):
+        i, j = numpy.minimum(i, j), numpy.maximum(i, j)
+        n = len(self.genes)
+        return n * i - (i * (i + 1)) // 2 + (j - i - 1)
+
+    def value(self, i, j):
+        if self.values.ndim == 2:
+            return float(self.values[i, j])
+        if i == j:
+            return 0.
+        return float(self.values[self.index(i, j)])
+
+    def to_dense(self):
+        if self.values.ndim == 2:
+            return self.values
+        return scipy.spatial.distance.squareform(self.values, checks=False)
+
+    def dense_rows(self, rows):
+        # Rows of to_dense() without building the full square matrix.
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        if self.values.ndim == 2:
+            return numpy.asarray(self.values[rows], dtype=numpy.float64)
+        cols = numpy.arange(len(self.genes))
+        dense = numpy.zeros((len(rows), len(cols)))
+        off = rows[:, None] != cols[None, :]
+        dense[off] = self.values[self.index(rows[:, None], cols[None, :])[off]]
+        return dense
+
+
+class _PairRow(object):
+
+    def __init__(self, pairs, row):
+        self.pairs = pairs
+        self.row = row
+
+    def __getitem__(self, gene):
+        col = self.pairs.gene_index.get(gene)
+        if self.row is None or col is None:
+            return 0.
+        return self.pairs.value(self.row, col)
+
+    def keys(self):
+        return self.pairs.genes
+
+    def items(self):
+        return [(gene, self[gene]) for gene in self.pairs.genes]
+
+
+def discretize_counts(matrix):
+    # Bin every expressed (cell, gene) entry once by its integer count. Each
+    # level is one (gene, count) pair and becomes a column of a binary
+    # cells x levels indicator matrix; levels of a gene are contiguous.
+    matrix = csc_matrix(matrix)
+    matrix.eliminate_zeros()
+    n_genes = matrix.shape[1]
+    counts = numpy.floor(matrix.data).astype(numpy.int64)
+    gene_of = numpy.repeat(numpy.arange(n_genes, dtype=numpy.int64), numpy.diff(matrix.indptr))
+    width = int(counts.max()) + 1 if len(counts) else 1
+    levels, level_of = numpy.unique(gene_of * width + counts, return_inverse=True)
+    indicator = csc_matrix((numpy.ones(len(counts), dtype=numpy.int32), (matrix.indices, level_of.ravel())),
+                           shape=(matrix.shape[0], len(levels)))
+    level_gene = levels // width
+    level_value = levels % width
+    level_ptr = numpy.searchsorted(level_gene, numpy.arange(n_genes + 1))
+    return indicator, level_gene, level_value, level_ptr
+
+
+def _histogram_edges(lower, upper, bins):
+    # Same outer edges as numpy.histogram2d with range=None.
+    lower = lower.astype(numpy.float64)
+    upper = upper.astype(numpy.float64)
+    flat = lower == upper
+    lower = numpy.where(flat, lower - 0.5, lower)
+    upper = numpy.where(flat, upper + 0.5, upper)
+    return lower, upper, (upper - lower) / bins
+
+
+def _histogram_bins(x, lower, upper, step, bins):
+    # Reproduces searchsorted on the numpy.linspace edges, including the
+    # closed last bin, so joint bin counts match numpy.histogram2d exactly.
+    def edge(k):
+        return numpy.where(k >= bins, upper, k * step + lower)
+    x = x.astype(numpy.float64)
+    k = numpy.clip(numpy.floor((x - lower) / step), 0, bins).astype(numpy.int64)
+    k += (k < bins) & (edge(k + 1) <= x)
+    k -= edge(k) > x
+    return numpy.minimum(k, bins - 1)
+
+
+def _pair_mutual_information(pair, x, y, count, num_cells, min_pct, max_pct, bins=10):
+    order = numpy.argsort(pair, kind="stable")
+    pair, x, y, count = pair[order], x[order], y[order], count[order]
+    pairs, starts, inverse = numpy.unique(pair, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    common = numpy.bincount(inverse, weights=count)
+    keep = (common / num_cells >= min_pct) & (common / num_cells <= max_pct)
+    xlow, xhigh, xstep = _histogram_edges(numpy.minimum.reduceat(x, starts), numpy.maximum.reduceat(x, starts), bins)
+    ylow, yhigh, ystep = _histogram_edges(numpy.minimum.reduceat(y, starts), numpy.maximum.reduceat(y, starts), bins)
+    xbin = _histogram_bins(x, xlow[inverse], xhigh[inverse], xstep[inverse], bins)
+    ybin = _histogram_bins(y, ylow[inverse], yhigh[inverse], ystep[inverse], bins)
+
+    cells, cell_of = numpy.unique((inverse * bins + xbin) * bins + ybin, return_inverse=True)
+    cell_of = cell_of.ravel()
+    joint = numpy.bincount(cell_of, weights=count)
+    cell_pair = cells // (bins * bins)
+    xmarginal = numpy.bincount(cells // bins, weights=joint, minlength=len(pairs) * bins)
+    ymarginal = numpy.bincount(cell_pair * bins + cells % bins, weights=joint, minlength=len(pairs) * bins)
+
+    # histogram2d(density=True) divides by the bin area, so the score is
+    # sum p/a * log2(p * a / (px * py)) rather than textbook MI.
+    n = common[cell_pair]
+    area = xstep[cell_pair] * ystep[cell_pair]
+    px = xmarginal[cells // bins]
+    py = ymarginal[cell_pair * bins + cells % bins]
+    terms = joint / (n * area) * numpy.log2(joint * n * area / (px * py))
+    mi = numpy.bincount(cell_pair, weights=terms, minlength=len(pairs))
+    return pairs[keep], mi[keep]
+
+
+def _mi_tile(indicator, level_gene, level_value, level_ptr, tile, block_size, min_pct, max_pct):
+    a, b = tile
+    num_cells = indicator.shape[0]
+    n_genes = len(level_ptr) - 1
+    astart, aend = level_ptr[a], level_ptr[min(a + block_size, n_genes)]
+    bstart, bend = level_ptr[b], level_ptr[min(b + block_size, n_genes)]
+    joint = (indicator[:, astart:aend].T.tocsr() @ indicator[:, bstart:bend]).tocoo()
+    gi = level_gene[astart + joint.row]
+    gj = level_gene[bstart + joint.col]
+    upper = gi < gj
+    if not upper.any():
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+    gi, gj = gi[upper], gj[upper]
+    pair = n_genes * gi - (gi * (gi + 1)) // 2 + (gj - gi - 1)
+    return _pair_mutual_information(pair,
+                                    level_value[astart + joint.row[upper]],
+                                    level_value[bstart + joint.col[upper]],
+                                    joint.data[upper].astype(numpy.float64),
+                                    num_cells, min_pct, max_pct)
+
+
+_mi_worker = dict()
+
+
+def _init_mi_worker(path, shape, block_size, min_pct, max_pct):
+    # Arrays are memory-mapped from the parent's scratch directory, so every
+    # worker shares one physical copy through the page cache.
+    load = lambda name: numpy.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+    _mi_worker["indicator"] = csc_matrix((load("data"), load("indices"), load("indptr")), shape=shape)
+    _mi_worker["level_gene"] = load("level_gene")
+    _mi_worker["level_value"] = load("level_value")
+    _mi_worker["level_ptr"] = load("level_ptr")
+    _mi_worker["condensed"] = numpy.load(os.path.join(path, "condensed.npy"), mmap_mode="r+")
+    _mi_worker["args"] = (block_size, min_pct, max_pct)
+
+
+def _run_mi_tile(tile):
+    w = _mi_worker
+    pairs, mi = _mi_tile(w["indicator"], w["level_gene"], w["level_value"], w["level_ptr"], tile, *w["args"])
+    w["condensed"][pairs] = mi
+    return len(pairs)
+
+
+def _scratch_dir(size):
+    # /dev/shm (RAM-backed) when it has room for size bytes, else the default
+    # temp directory; a memory map past the end of a full tmpfs crashes
+    # with SIGBUS instead of raising.
+    shm = "/dev/shm"
+    if os.path.isdir(shm) and os.access(shm, os.W_OK) and shutil.disk_usage(shm).free > size:
+        return shm
+    return None
+
+
+def mutual_information(matrix, min_pct=0.0, max_pct=0.75, block_size=256, threads=1, scratch_dir=None):
+    # Binned mutual information for every gene pair (columns of a cells x
+    # genes matrix) over the cells expressing both genes, returned as a
+    # condensed upper-triangular vector (scipy.spatial.distance ordering).
+    # Joint counts come from blocked indicator products instead of a
+    # histogram per pair; scores agree with the numpy.histogram2d
+    # formulation to within 1e-9 relative tolerance (bin widths are taken
+    # as uniform rather than from numpy.diff of the edges).
+    #
+    # The pair space is cut into block_size x block_size tiles. With
+    # threads > 1 the tiles run on a process pool; each worker writes its
+    # disjoint slice of the preallocated condensed array in place. The
+    # arrays the workers share are written to scratch_dir, by default
+    # /dev/shm when it has room for them.
+    n_genes = matrix.shape[1]
+    indicator, level_gene, level_value, level_ptr = discretize_counts(matrix)
+    blocks = list(range(0, n_genes, block_size))
+    tiles = [(a, b) for x, a in enumerate(blocks) for b in blocks[x:]]
+    size = n_genes * (n_genes - 1) // 2
+    if threads is None or threads < 2 or len(tiles) < 2:
+        condensed = numpy.zeros(size, dtype=numpy.float64)
+        for tile in tqdm.tqdm(tiles):
+            pairs, mi = _mi_tile(indicator, level_gene, level_value, level_ptr, tile, block_size, min_pct, max_pct)
+            condensed[pairs] = mi
+        return condensed
+
+    arrays = {"data": indicator.data, "indices": indicator.indices, "indptr": indicator.indptr,
+              "level_gene": level_gene, "level_value": level_value, "level_ptr": level_ptr}
+    if scratch_dir is None:
+        scratch_dir = _scratch_dir(sum(array.nbytes for array in arrays.values()) + size * 8)
+    with tempfile.TemporaryDirectory(prefix="genevector_mi_", dir=scratch_dir) as path:
+        for name, array in arrays.items():
+            numpy.save(os.path.join(path, name + ".npy"), array)
+        shared = numpy.lib.format.open_memmap(os.path.join(path, "condensed.npy"), mode="w+",
+                                              dtype=numpy.float64, shape=(size,))
+        del indicator, arrays
+        with multiprocessing.Pool(threads, initializer=_init_mi_worker,
+                                  initargs=(path, (matrix.shape[0], len(level_gene)), block_size, min_pct, max_pct)) as pool:
+            for _ in tqdm.tqdm(pool.imap_unordered(_run_mi_tile, tiles), total=len(tiles)):
+                pass
+        condensed = numpy.array(shared)
+        del shared
+    return condensed
+
+
+def correlation_from_cooccurrence(coocc, n):
+    # Pearson correlation of binary columns from B.T @ B alone: the diagonal
+    # holds the column sums, so the cells x genes matrix is never needed.
+    # Matches numpy.corrcoef(B.T), including nan for constant columns.
+    sums = numpy.diag(coocc).astype(numpy.float64)
+    variance = n * sums - sums * sums
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        corr = coocc.astype(numpy.float64)
+        corr *= n
+        corr -= numpy.outer(sums, sums)
+        corr /= numpy.sqrt(variance)[:, None]
+        corr /= numpy.sqrt(variance)[None, :]
+    return numpy.clip(corr, -1, 1, out=corr)
+
+
+def off_diagonal_indices(n_genes, positions=None, dtype="int64", chunk_size=1 << 22):
+    # Row and column of the off-diagonal pairs of an n_genes x n_genes matrix
+    # in row-major order (numpy.nonzero(~eye)), or of the given positions in
+    # that order. Filled chunk by chunk straight into dtype, so no n_genes^2
+    # mask or int64 copy is built.
+    total = n_genes * (n_genes - 1) if positions is None else len(positions)
+    i_idx = numpy.empty(total, dtype=dtype)
+    j_idx = numpy.empty(total, dtype=dtype)
+    for start in range(0, total, chunk_size):
+        stop = min(start + chunk_size, total)
+        k = numpy.arange(start, stop, dtype=numpy.int64) if positions is None else positions[start:stop]
+        i, r = numpy.divmod(k, n_genes - 1)
+        i_idx[start:stop] = i
+        j_idx[start:stop] = r + (r >= i)
+    return i_idx, j_idx
+
+
 class GeneVectorDataset(Dataset):
 
-    def __init__(self, adata, device="cpu", expression=None):
-        self.data = Context.build(adata, expression=expression)
+    def __init__(self, adata, device="cpu", expression=None, threads=2):
+        self.data = Context.build(adata, expression=expression, threads=threads)
         self._word2id = self.data.gene2id
         self._id2word = self.data.id2gene
         self._vocab_len = len(self._word2id)
         self.device = device
 
-    def generate_mi_scores(self, min_pct=0.00,max_pct=0.75):
-        mi_scores = collections.defaultdict(lambda : collections.defaultdict(float))
-        bcs = dict()
-        num_cells = len(self.data.cells)
-        vgenes = []
-        for gene, bc in self.data.data.items():
-            bcs[gene] = set(bc)
-            vgenes.append(gene)
-        pairs = list(itertools.combinations(vgenes, 2))
-        counts = collections.defaultdict(lambda : collections.defaultdict(int))
-        for c, p in self.data.expression.items():
-            for g,v in p.items():
-                counts[g][c] += int(v)
-        for p1,p2 in tqdm.tqdm(pairs):
-            common = bcs[p1].intersection(bcs[p2])
-            if len(common) / num_cells < min_pct or len(common) / num_cells > max_pct:
-                continue
-            x = []
-            y = []
-            countsp1 = counts[p1]
-            countsp2 = counts[p2]
-            for c in common:
-                x.append(countsp1[c])
-                y.append(countsp2[c])
-            pxy, xedges, yedges = numpy.histogram2d(x,y,density=True)
-            px = np.sum(pxy, axis=1)
-            py = np.sum(pxy, axis=0)
-            px_py = px[:, None] * py[None, :]
-            nzs = pxy > 0
-            mi = np.sum(pxy[nzs] * np.log2(pxy[nzs] / px_py[nzs]))
-            mi_scores[p1][p2] = mi
-            mi_scores[p2][p1] = mi
-        self.mi_scores = mi_scores
-
-    def create_inputs_outputs(self,scale=100.0, max_pct=0.75, min_pct=0.0):
+    def generate_mi_scores(self, min_pct=0.00, max_pct=0.75, block_size=256, threads=None):
+        if threads is None:
+            threads = self.data.threads
+        genes = list(self.data.data.keys())
+        matrix = self.data.expression_matrix()
+        print("Computing mutual information.")
+        mi = mutual_information(matrix, min_pct=min_pct, max_pct=max_pct, block_size=block_size, threads=threads)
+        self.mi_scores = PairMatrix(mi, genes)
+
+    def binary_expression(self):
+        # Cells x genes indicator over every gene detected in at least one
+        # cell, columns in sorted gene order; empty cells are dropped.
+        matrix = self.data.matrix
+        columns = numpy.flatnonzero(matrix.getnnz(axis=0))
+        genes = [self.data.genes[i] for i in columns]
+        order = sorted(range(len(genes)), key=genes.__getitem__)
+        binary = matrix[matrix.getnnz(axis=1) > 0][:, columns[order]]
+        # int32 ones, so binary.T @ binary holds exact integer co-occurrence
+        # counts at half the size of float64.
+        binary = csr_matrix((numpy.ones(binary.nnz, dtype=numpy.int32), binary.indices, binary.indptr), shape=binary.shape)
+        return [genes[i] for i in order], binary
+
+    def create_inputs_outputs(self,scale=100.0, max_pct=0.75, min_pct=0.0, sparse=False, negatives=None, cache=None, index_dtype="int64", target_dtype="float32"):
         print("Generating inputs and outputs.")
-        import pandas
+        inputs = None
+        if cache is not None:
+            if not isinstance(cache, InputCache):
+                cache = InputCache(cache)
+            key = fingerprint(self.data, scale=float(scale), max_pct=float(max_pct), min_pct=float(min_pct))
+            inputs = cache.load(key)
+            if inputs is not None:
+                print("Loaded inputs from cache ({}).".format(key))
+        if inputs is None:
+            inputs = self.compute_inputs(scale=scale, max_pct=max_pct, min_pct=min_pct)
+            if cache is not None:
+                cache.save(key, inputs)
+        self.load_inputs(inputs, sparse=sparse, negatives=negatives, index_dtype=index_dtype, target_dtype=target_dtype)
+
+    def compute_inputs(self, scale=100.0, max_pct=0.75, min_pct=0.0, block_size=1 << 18):
         self.generate_mi_scores(max_pct=max_pct, min_pct=min_pct)
+        all_genes, binary = self.binary_expression()
+        gene_index, _ = Context.index_geneset(all_genes)
 
-        from sklearn import feature_extraction
-        vectorizer = feature_extraction.DictVectorizer(sparse=True)
-        corr_matrix = vectorizer.fit_transform(list(self.data.expression.values()))
-        corr_matrix[corr_matrix != 0] = 1
-
-        all_genes = vectorizer.feature_names_
-
+        print("Decomposing")
+        coocc = (binary.T @ binary).toarray()
+        cov = correlation_from_cooccurrence(coocc, binary.shape[0])
+
+        # x_ij = max(mi * coocc / n_cells * scale, 0) over the off-diagonal
+        # pairs, computed a block of rows (about block_size pairs) at a time
+        # straight into the float32 output, so no dense n_genes^2 float64
+        # MI or product matrix is built.
+        n_genes = len(all_genes)
+        mi_genes = numpy.array([gene_index[gene] for gene in self.mi_scores.genes], dtype=numpy.int64)
+        mi_rows = numpy.full(n_genes, -1, dtype=numpy.int64)
+        mi_rows[mi_genes] = numpy.arange(len(mi_genes))
+        xij = numpy.empty(n_genes * (n_genes - 1), dtype=numpy.float32)
+        rows_per_block = max(1, block_size // max(n_genes, 1))
+        for start in range(0, n_genes, rows_per_block):
+            stop = min(start + rows_per_block, n_genes)
+            local = numpy.flatnonzero(mi_rows[start:stop] >= 0)
+            mi = numpy.zeros((stop - start, n_genes))
+            mi[numpy.ix_(local, mi_genes)] = self.mi_scores.dense_rows(mi_rows[start:stop][local])
+            block = mi * (coocc[start:stop] / len(self.data.cells)) * scale
+            off = numpy.ones(block.shape, dtype=bool)
+            off[numpy.arange(stop - start), numpy.arange(start, stop)] = False
+            xij[start * (n_genes - 1):stop * (n_genes - 1)] = numpy.maximum(block[off], 0.)
+        return {"genes": numpy.array(all_genes, dtype=str),
+                "mi_genes": numpy.array(self.mi_scores.genes, dtype=str),
+                "mi": self.mi_scores.values,
+                "coocc": coocc,
+                "cov": cov,
+                "xij": xij}
+
+    def load_inputs(self, inputs, sparse=False, negatives=None, index_dtype="int64", target_dtype="float32"):
+        all_genes = inputs["genes"].tolist()
         gene_index = {w: idx for (idx, w) in enumerate(all_genes)}
         index_gene = {idx: w for (idx, w) in enumerate(all_genes)}
         self.data.gene2id = gene_index
         self.data.id2gene = index_gene
         self.data.expressed_genes = all_genes
-
-        corr_matrix = pandas.DataFrame(data=corr_matrix.todense(),columns=all_genes)
-        corr_df = corr_matrix
-
-        print("Decomposing")
-        coocc = numpy.array(corr_df.T.dot(corr_df))
-
-        corr_matrix = numpy.transpose(corr_matrix.to_numpy())
-        cov = numpy.corrcoef(corr_matrix)
-
-        self._i_idx = list()
-        self._j_idx = list()
-        self._xij = list()
-        import collections
-        self.correlation = collections.defaultdict(dict)
-
-        for gene, row in tqdm.tqdm(zip(all_genes, cov)):
-            for cgene, value in zip(all_genes, row):
-                if gene == cgene: continue
-                wi = self.data.gene2id[gene]
-                ci = self.data.gene2id[cgene]
-                self._i_idx.append(wi)
-                self._j_idx.append(ci)
-                self.correlation[gene][cgene] = value
-                value = self.mi_scores[gene][cgene]
-                value = value * (coocc[wi,ci]/len(self.data.cells)) * scale
-                if value > 0:
-                    self._xij.append(value)
-                else:
-                    self._xij.append(0.)
-        if self.device == "cuda":
-            self._i_idx = torch.cuda.LongTensor(self._i_idx).cuda()
-            self._j_idx = torch.cuda.LongTensor(self._j_idx).cuda()
-            self._xij = torch.cuda.FloatTensor(self._xij).cuda()
-        else:
-            self._i_idx = torch.LongTensor(self._i_idx).to("cpu")
-            self._j_idx = torch.LongTensor(self._j_idx).to("cpu")
-            self._xij = torch.FloatTensor(self._xij).to("cpu")
+        self.mi_scores = PairMatrix(inputs["mi"], inputs["mi_genes"].tolist())
+        self.correlation = PairMatrix(inputs["cov"], all_genes)
+        coocc = inputs["coocc"]
+        xij = inputs["xij"]
+        n_genes = len(all_genes)
+        if index_dtype not in ("int64", "int32"):
+            raise ValueError("index_dtype must be int64 or int32.")
+        if target_dtype not in ("float32", "bfloat16", "float16"):
+            raise ValueError("target_dtype must be float32, bfloat16 or float16.")
+        if target_dtype == "float16" and len(xij) and xij.max() > numpy.finfo(numpy.float16).max:
+            raise ValueError("Targets up to {:.1f} overflow float16 (max 65504); use target_dtype=\"bfloat16\" "
+                             "or a smaller scale.".format(float(xij.max())))
+        positions = None
+
+        # Sparse targets keep only the positive pairs; get_batches then adds
+        # a fresh draw of zero pairs every epoch (word2vec negative sampling
+        # with a unigram^0.75 noise distribution over gene frequency).
+        self.sparse = sparse
+        if sparse:
+            positive = xij > 0
+            if not positive.any():
+                raise ValueError("sparse=True needs pairs with positive targets, but all {} are zero; "
+                                 "train with sparse=False or check the input counts.".format(len(xij)))
+            positions = numpy.flatnonzero(positive)
+            xij = xij[positive]
+            noise = numpy.diag(coocc) ** 0.75
+            self._noise = noise / noise.sum()
+            self.negatives = len(xij) if negatives is None else int(negatives)
+            print("Kept {} of {} pairs with nonzero targets.".format(len(xij), n_genes * (n_genes - 1)))
+
+        # int32 indices and bfloat16/float16 targets halve the memory per
+        # triplet (20 -> 10 bytes); the loss is still computed in float32.
+        i_idx, j_idx = off_diagonal_indices(n_genes, positions=positions, dtype=index_dtype)
+        if sparse:
+            self._positive_keys = i_idx.astype(numpy.int64) * n_genes + j_idx
+        self._i_idx = torch.from_numpy(i_idx).to(self.device)
+        self._j_idx = torch.from_numpy(j_idx).to(self.device)
+        # Cast from the float32 buffer itself; only the target-dtype tensor
+        # is allocated (none at all for float32 on CPU).
+        xij = numpy.require(xij, dtype=numpy.float32, requirements=["C", "W"])
+        self._xij = torch.from_numpy(xij).to(self.device, getattr(torch, target_dtype))
         self.coocc = coocc
-        self.cov = cov
-
-
-    def get_batches(self, batch_size):
-        if self.device == "cuda":
-            rand_ids = torch.cuda.LongTensor(np.random.choice(len(self._xij), len(self._xij), replace=False))
-        else:
-            rand_ids = torch.LongTensor(np.random.choice(len(self._xij), len(self._xij), replace=False))
+        self.cov = inputs["cov"]
+
+    def sample_negatives(self, n, rng=np.random):
+        n_genes = len(self._noise)
+        centers = self._positive_keys[rng.randint(0, len(self._positive_keys), n)] // n_genes
+        contexts = rng.choice(n_genes, n, p=self._noise)
+        keys = centers * n_genes + contexts
+        found = np.searchsorted(self._positive_keys, keys)
+        found[found == len(self._positive_keys)] = 0
+        zero = (centers != contexts) & (self._positive_keys[found] != keys)
+        return torch.from_numpy(centers[zero]).to(self.device), torch.from_numpy(contexts[zero]).to(self.device)
+
+    def get_batches(self, batch_size, seed=None):
+        # A seed makes the epoch (negatives and order) reproducible without
+        # touching the global random state.
+        xij, i_idx, j_idx = self._xij, self._i_idx, self._j_idx
+        if getattr(self, "sparse", False) and self.negatives > 0:
+            ni, nj = self.sample_negatives(self.negatives, rng=np.random if seed is None else np.random.RandomState(seed))
+            xij = torch.cat([xij, torch.zeros(len(ni), dtype=xij.dtype, device=xij.device)])
+            i_idx = torch.cat([i_idx, ni.to(i_idx.dtype)])
+            j_idx = torch.cat([j_idx, nj.to(j_idx.dtype)])
+        generator = None
+        if seed is not None:
+            generator = torch.Generator(device=xij.device)
+            generator.manual_seed(int(seed))
+        rand_ids = torch.randperm(len(xij), generator=generator, device=xij.device)
         for p in range(0, len(rand_ids), batch_size):
             batch_ids = rand_ids[p:p+batch_size]
-            yield self._xij[batch_ids], self._i_idx[batch_ids], self._j_idx[batch_ids]
+            yield xij[batch_ids], i_idx[batch_ids], j_idx[batch_ids]
@@ -0,0 +1,105 @@
+import argparse
+import os
+
+import numpy
+import scanpy as sc
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from genevector.data import GeneVectorDataset
+from genevector.model import GeneVector, compile_model
+
+
+def shard(dataset, rank, world_size):
+    # Each rank keeps every world_size-th (i, j, x_ij) triplet and draws its
+    # share of the negatives in sparse mode.
+    dataset._xij = dataset._xij[rank::world_size].contiguous()
+    dataset._i_idx = dataset._i_idx[rank::world_size].contiguous()
+    dataset._j_idx = dataset._j_idx[rank::world_size].contiguous()
+    if getattr(dataset, "sparse", False):
+        dataset.negatives = dataset.negatives // world_size
+
+
+def run(gene_vector, epochs, threads=None, **kwargs):
+    # Trains gene_vector on this rank's shard inside an initialized gloo
+    # process group. Gradients are averaged across ranks every step, so each
+    # step covers world_size batches; rank 0 writes the vectors.
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    torch.set_num_threads(threads or max(1, (os.cpu_count() or 1) // world_size))
+    # Epoch order and negatives are seeded per rank inside GeneVector.train.
+    shard(gene_vector.dataset, rank, world_size)
+    gene_vector.ddp = DistributedDataParallel(gene_vector.model)
+    gene_vector.forward = compile_model(gene_vector.ddp) if gene_vector.compile else gene_vector.ddp
+    gene_vector.train(epochs, **kwargs)
+
+
+def _worker(rank, world_size, gene_vector, epochs, master_addr, master_port, threads, kwargs):
+    os.environ["MASTER_ADDR"] = master_addr
+    os.environ["MASTER_PORT"] = str(master_port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        run(gene_vector, epochs, threads=threads, **kwargs)
+    finally:
+        dist.destroy_process_group()
+
+
+def train(gene_vector, epochs, nprocs=None, master_addr="127.0.0.1", master_port=29500, threads=None, **kwargs):
+    # Forks nprocs local ranks, which inherit the prepared dataset without
+    # copying it. The trained vectors are in gene_vector.output_file_name.
+    nprocs = nprocs or os.cpu_count()
+    mp.start_processes(_worker, args=(nprocs, gene_vector, epochs, master_addr, master_port, threads, kwargs),
+                       nprocs=nprocs, start_method="fork")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Data-parallel GeneVector training on CPU.")
+    parser.add_argument("h5ad")
+    parser.add_argument("output")
+    parser.add_argument("--nprocs", type=int, default=None)
+    parser.add_argument("--epochs", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=100000)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--threshold", type=float, default=1e-5)
+    parser.add_argument("--scale", type=float, default=1000)
+    parser.add_argument("--max-pct", type=float, default=0.5)
+    parser.add_argument("--min-pct", type=float, default=0.0)
+    parser.add_argument("--sparse", action="store_true")
+    parser.add_argument("--negatives", type=int, default=None)
+    parser.add_argument("--cache", default=None)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--checkpoint-every", type=int, default=1)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--port", type=int, default=29500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    numpy.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    dataset = GeneVectorDataset(sc.read(args.h5ad))
+    gene_vector = GeneVector(dataset, args.output, emb_dimension=args.dim, batch_size=args.batch_size,
+                             initial_lr=args.lr, threshold=args.threshold, scale=args.scale,
+                             max_pct=args.max_pct, min_pct=args.min_pct, sparse=args.sparse,
+                             negatives=args.negatives, cache=args.cache, compile=args.compile)
+    resume_from = None
+    if args.resume and args.checkpoint and os.path.exists(args.checkpoint):
+        resume_from = args.checkpoint
+    options = dict(checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every, resume_from=resume_from)
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        # Started by torchrun (possibly across nodes): one rank per process.
+        dist.init_process_group("gloo")
+        try:
+            run(gene_vector, args.epochs, threads=args.threads, **options)
+        finally:
+            dist.destroy_process_group()
+    else:
+        train(gene_vector, args.epochs, nprocs=args.nprocs, master_port=args.port, threads=args.threads, **options)
+
+
+if __name__ == "__main__":
+    main()
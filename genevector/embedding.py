@@ -21,53 +21,158 @@ import matplotlib as mpl
 
 import numpy
 import operator
+import inspect
 import random
 import pickle
 import collections
+import collections.abc
 import sys
 import os
+import scipy.sparse
+from scipy.sparse import csr_matrix
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import squareform
+from multiprocessing.pool import ThreadPool
+import anndata
+
+from genevector.data import Context
+from genevector.vectors import has_vectors, read_vectors, normalize
 
 class GeneEmbedding(object):
 
     def __init__(self, embedding_file, dataset, vector="1"):
         if vector not in ("1","2","average"):
             raise ValueError("Select the weight vector from: ('1','2','average')")
-        if vector == "average":
-            print("Loading average of 1st and 2nd weights.")
-            avg_embedding = embedding_file.replace(".vec","_avg.vec")
-            secondary_weights = embedding_file.replace(".vec","2.vec")
-            GeneEmbedding.average_vector_results(embedding_file,secondary_weights,avg_embedding)
-            self.embeddings = self.read_embedding(avg_embedding)
-        elif vector == "1":
-            print("Loading first weights.")
-            self.embeddings = self.read_embedding(embedding_file)
-        elif vector == "2":
-            print("Loading second weights.")
-            secondary_weights = embedding_file.replace(".vec","2.vec")
-            self.embeddings = self.read_embedding(secondary_weights)
-        self.vector = []
-        self.context = dataset.data
+        secondary_weights = embedding_file.replace(".vec","2.vec")
+        if has_vectors(embedding_file):
+            if vector == "average":
+                print("Loading average of 1st and 2nd weights.")
+                genes, primary = read_vectors(embedding_file)
+                _, secondary = read_vectors(secondary_weights)
+                matrix = (primary + secondary) / 2
+            elif vector == "1":
+                print("Loading first weights.")
+                genes, matrix = read_vectors(embedding_file)
+            elif vector == "2":
+                print("Loading second weights.")
+                genes, matrix = read_vectors(secondary_weights)
+        else:
+            if vector == "average":
+                print("Loading average of 1st and 2nd weights.")
+                avg_embedding = embedding_file.replace(".vec","_avg.vec")
+                GeneEmbedding.average_vector_results(embedding_file,secondary_weights,avg_embedding)
+                embeddings = self.read_embedding(avg_embedding)
+            elif vector == "1":
+                print("Loading first weights.")
+                embeddings = self.read_embedding(embedding_file)
+            elif vector == "2":
+                print("Loading second weights.")
+                embeddings = self.read_embedding(secondary_weights)
+            genes = list(embeddings.keys())
+            matrix = numpy.array(list(embeddings.values()), dtype=numpy.float32)
+        self.context = dataset.data if dataset is not None else None
         self.embedding_file = embedding_file
-        self.vector = []
-        self.genes = []
-        for gene in tqdm.tqdm(self.embeddings.keys()):
-            self.vector.append(self.embeddings[gene])
-            self.genes.append(gene)
-
-    def select_cosine_threshold(self,plot=None):
-        gene_sets = set()
+        self.index(genes, matrix)
+
+    def index(self, genes, matrix):
+        # One float32 genes x dimensions matrix, its L2-normalized copy for
+        # cosine queries and a gene -> row index. embeddings and vector are
+        # kept as row views for code that expects the old dict/list layout.
+        self.genes = list(genes)
+        self.gene_index = {gene: i for i, gene in enumerate(self.genes)}
+        self.matrix = numpy.asarray(matrix, dtype=numpy.float32)
+        self.vector = self.matrix
+        self.embeddings = dict(zip(self.genes, self.matrix))
+        self.normalized = GeneEmbedding.normalize(self.matrix)
+
+    def rows(self, genes):
+        return numpy.array([self.gene_index.get(gene, -1) for gene in genes], dtype=numpy.int64)
+
+    def transform(self, adata, chunk_size=100000):
+        # Cell vectors for a new AnnData without building a Context: its genes
+        # are mapped onto this vocabulary once and X is embedded chunk_size
+        # rows at a time exactly as CellEmbedding does.
+        rows = self.rows(adata_genes(adata))
+        blocks = []
+        for start in range(0, adata.shape[0], chunk_size):
+            chunk = Context.positive_matrix(adata.X[start:start + chunk_size])
+            blocks.append(weighted_vectors(embedding_weights(chunk, rows, len(self.genes)), self.matrix))
+        if not blocks:
+            return numpy.zeros((0, self.matrix.shape[1]), dtype=numpy.float32)
+        return numpy.concatenate(blocks)
+
+    normalize = staticmethod(normalize)
+
+    @staticmethod
+    def top_k(similarities, k=None):
+        # Column order of each row of similarities, best first. With k set,
+        # argpartition selects the k best before sorting just those.
+        n = similarities.shape[1]
+        if k is None or k >= n:
+            return numpy.argsort(-similarities, axis=1, kind="stable")
+        top = numpy.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        order = numpy.argsort(-numpy.take_along_axis(similarities, top, axis=1), axis=1, kind="stable")
+        return numpy.take_along_axis(top, order, axis=1)
+
+    def similarities(self, queries):
+        if isinstance(queries, str):
+            queries = [queries]
+        if len(queries) and isinstance(queries[0], str):
+            queries = self.normalized[[self.gene_index[gene] for gene in queries]]
+        else:
+            queries = GeneEmbedding.normalize(numpy.atleast_2d(queries))
+        return queries @ self.normalized.T
+
+    def most_similar(self, queries, k=10):
+        similarities = self.similarities(queries)
+        top = GeneEmbedding.top_k(similarities, k)
+        genes = numpy.array(self.genes, dtype=object)[top]
+        return genes, numpy.take_along_axis(similarities, top, axis=1)
+
+    def _similarity_frame(self, similarities, rows=None, k=None):
+        if rows is None:
+            rows = numpy.arange(len(self.genes))
+        order = rows[GeneEmbedding.top_k(similarities[rows].reshape(1, -1), k)[0]]
+        return pandas.DataFrame.from_dict({"Gene": [self.genes[i] for i in order],
+                                           "Similarity": similarities[order].astype(numpy.float64)})
+
+    def cosine_distances(self):
+        matrix = normalize(self.matrix, dtype=numpy.float64)
+        distances = 1.0 - matrix @ matrix.T
+        numpy.clip(distances, 0.0, 2.0, out=distances)
+        numpy.fill_diagonal(distances, 0.0)
+        return distances
+
+    def select_cosine_threshold(self, plot=None, thresholds=None, threads=1):
+        # The complete-linkage tree is built once from the cosine distances
+        # and cut at every threshold; the same distances give the silhouette
+        # scores, which are computed once per distinct partition.
+        if thresholds is None:
+            thresholds = numpy.linspace(0.0,1,100)
+        distances = self.cosine_distances()
+        tree = linkage(squareform(distances, checks=False), method="complete")
+        # Merges strictly below the threshold, as AgglomerativeClustering's
+        # distance_threshold; fcluster keeps merges at or below t.
+        cuts = [fcluster(tree, numpy.nextafter(t, -numpy.inf), criterion="distance") for t in thresholds]
+        # Cuts of one tree with the same number of clusters are the same partition.
+        partitions = dict()
+        for labels in cuts:
+            n_clusters = labels.max()
+            if 1 < n_clusters < len(labels):
+                partitions[n_clusters] = labels
+        score = lambda labels: metrics.silhouette_score(distances, labels, metric="precomputed")
+        if threads > 1:
+            with ThreadPool(threads) as pool:
+                scores = dict(zip(partitions.keys(), pool.map(score, partitions.values())))
+        else:
+            scores = {n: score(labels) for n, labels in partitions.items()}
         cosine = []
         sill = []
         cosine_max = 0.0
         max_score = 0.0
-        for i in numpy.linspace(0.0,1,100):
-            clustering = AgglomerativeClustering(affinity="cosine",
-                                                 linkage="complete",
-                                                 distance_threshold=i,
-                                                 n_clusters=None).fit(self.vector)
-            clusters = collections.defaultdict(list)
-            if len(set(clustering.labels_)) > 1 and len(set(clustering.labels_)) != len(clustering.labels_):
-                score = metrics.silhouette_score(self.vector, clustering.labels_, metric='cosine')
+        for i, labels in zip(thresholds, cuts):
+            if labels.max() in scores:
+                score = scores[labels.max()]
                 sill.append(score)
                 cosine.append(i)
                 if score > max_score:
@@ -183,55 +288,49 @@ class GeneEmbedding(object):
             metagenes[x].append(y)
         return metagenes
 
-    def compute_similarities(self, gene, subset=None, feature_type=None):
-        if gene not in self.embeddings:
+    def compute_similarities(self, gene, subset=None, feature_type=None, k=None):
+        if gene not in self.gene_index:
             return None
         if feature_type:
             subset = []
-            for gene in list(self.embeddings.keys()):
-                if feature_type == self.context.feature_types[gene]:
-                    subset.append(gene)
-        embedding = self.embeddings[gene]
-        distances = dict()
+            for target in self.genes:
+                if feature_type == self.context.feature_types[target]:
+                    subset.append(target)
+        rows = None
         if subset:
-            targets = set(list(self.embeddings.keys())).intersection(set(subset))
-        else:
-            targets = list(self.embeddings.keys())
-        for target in targets:
-            if target not in self.embeddings:
-                continue
-            v = self.embeddings[target]
-            distance = float(cosine_similarity(numpy.array(embedding).reshape(1, -1),numpy.array(v).reshape(1, -1))[0])
-            distances[target] = distance
-        sorted_distances = list(reversed(sorted(distances.items(), key=operator.itemgetter(1))))
-        genes = [x[0] for x in sorted_distances]
-        distance = [x[1] for x in sorted_distances]
-        df = pandas.DataFrame.from_dict({"Gene":genes, "Similarity":distance})
-        return df
+            rows = numpy.array(sorted(set(self.gene_index[target] for target in subset if target in self.gene_index)), dtype=int)
+        similarities = self.similarities([gene])[0]
+        return self._similarity_frame(similarities, rows=rows, k=k)
 
     def clusters(self, clusters):
-        average_vector = dict()
+        labels = numpy.asarray(clusters, dtype=object)[:len(self.context.expressed_genes)]
+        rows = self.rows(self.context.expressed_genes[:len(labels)])
+        found = rows >= 0
+        groups = GroupIndex.from_labels(labels[found])
+        rows = rows[found]
+        self.total_average_vector = list(self.matrix[rows].mean(axis=0, dtype=numpy.float64))
+        means = groups.means(self.matrix[rows]) - self.total_average_vector
+        average_vector = dict(zip(groups.names, means))
         gene_to_cluster = collections.defaultdict(list)
-        matrix = collections.defaultdict(list)
-        total_average_vector = []
-        for gene, cluster in zip(self.context.expressed_genes, clusters):
-            if gene in self.embeddings:
-                matrix[cluster].append(self.embeddings[gene])
-                gene_to_cluster[cluster].append(gene)
-                total_average_vector.append(self.embeddings[gene])
-        self.total_average_vector = list(numpy.average(total_average_vector, axis=0))
-        for cluster, vectors in matrix.items():
-            xvec = list(numpy.average(vectors, axis=0))
-            average_vector[cluster] = numpy.subtract(xvec,self.total_average_vector)
+        for cluster, members in zip(groups.names, numpy.split(groups.order, groups.offsets[1:-1])):
+            gene_to_cluster[cluster] = [self.genes[row] for row in rows[members]]
         return average_vector, gene_to_cluster
 
+    def group_index(self, gene_sets):
+        return GroupIndex.from_sets(gene_sets, self.gene_index)
+
+    def generate_vectors(self, gene_sets, statistic="median"):
+        # gene_sets maps a name to genes; returns the names and a matrix with
+        # the median (or mean) vector of each set's genes, nan for empty sets.
+        groups = self.group_index(gene_sets)
+        return groups.names, groups.reduce(self.matrix, statistic)
+
     def generate_vector(self, genes):
-        vector = []
-        for gene, vec in zip(self.genes, self.vector):
-            if gene in genes:
-                vector.append(vec)
-        assert len(vector) != 0, genes
-        return list(numpy.median(vector, axis=0))
+        rows = self.rows(genes)
+        rows = numpy.unique(rows[rows >= 0])
+        if len(rows) == 0:
+            raise ValueError("None of the genes are in the embedding: {}".format(genes))
+        return list(numpy.median(self.matrix[rows], axis=0))
 
     def cluster_definitions_as_df(self, top_n=20):
         similarities = self.cluster_definitions
@@ -254,33 +353,48 @@ class GeneEmbedding(object):
             vecs[gene] = list(map(float,line))
         return vecs, dims
 
-    def get_similar_genes(self, vector):
-        distances = dict()
-        targets = list(self.embeddings.keys())
-        for target in targets:
-            if target not in self.embeddings:
-                continue
-            v = self.embeddings[target]
-            distance = float(cosine_similarity(numpy.array(vector).reshape(1, -1),numpy.array(v).reshape(1, -1))[0])
-            distances[target] = distance
-        sorted_distances = list(reversed(sorted(distances.items(), key=operator.itemgetter(1))))
-        genes = [x[0] for x in sorted_distances]
-        distance = [x[1] for x in sorted_distances]
-        df = pandas.DataFrame.from_dict({"Gene":genes, "Similarity":distance})
-        return df
-
-    def generate_network(self, threshold=0.5):
+    def get_similar_genes(self, vector, k=None):
+        similarities = self.similarities(numpy.asarray(vector, dtype=numpy.float32))[0]
+        return self._similarity_frame(similarities, k=k)
+
+    def similarity_graph(self, threshold=0.5, block_size=1024, loops=False):
+        # Symmetric scipy.sparse adjacency of gene pairs with cosine similarity
+        # >= threshold, weighted by the similarity. Rows are scored in blocks
+        # against the genes from the block onwards, so only block_size x G
+        # similarities are dense at a time.
+        n = len(self.genes)
+        rows, cols, weights = [], [], []
+        for start in tqdm.tqdm(range(0, n, block_size)):
+            block = self.normalized[start:start + block_size] @ self.normalized[start:].T
+            r, c = numpy.nonzero((block >= threshold) & (block != 0))
+            keep = c > r if not loops else c >= r
+            r, c = r[keep], c[keep]
+            rows.append(r + start)
+            cols.append(c + start)
+            weights.append(block[r, c])
+        rows, cols, weights = numpy.concatenate(rows), numpy.concatenate(cols), numpy.concatenate(weights)
+        off = rows != cols
+        adjacency = scipy.sparse.coo_matrix((numpy.concatenate([weights, weights[off]]),
+                                             (numpy.concatenate([rows, cols[off]]), numpy.concatenate([cols, rows[off]]))),
+                                            shape=(n, n))
+        return adjacency.tocsr()
+
+    def write_edges(self, adjacency, path):
+        # Tab-separated gene, gene, similarity; one line per undirected edge.
+        upper = scipy.sparse.triu(adjacency).tocoo()
+        with open(path, "w") as f:
+            for i, j, weight in zip(upper.row, upper.col, upper.data):
+                f.write("{}\t{}\t{}\n".format(self.genes[i], self.genes[j], weight))
+
+    def generate_network(self, threshold=0.5, block_size=1024, edge_list=None):
+        adjacency = self.similarity_graph(threshold=threshold, block_size=block_size, loops=True)
+        if edge_list is not None:
+            self.write_edges(adjacency, edge_list)
+        upper = scipy.sparse.triu(adjacency).tocoo()
+        genes = numpy.array(self.genes, dtype=object)
         G = nx.Graph()
-        a = pandas.DataFrame.from_dict(self.embeddings).to_numpy()
-        similarities = cosine_similarity(a.T)
-        genes = list(self.embeddings.keys())
-        similarities[similarities < threshold] = 0
-        edges = []
-        nz = list(zip(*similarities.nonzero()))
-        for n in tqdm.tqdm(nz):
-            edges.append((genes[n[0]],genes[n[1]]))
-        G.add_nodes_from(genes)
-        G.add_edges_from(edges)
+        G.add_nodes_from(self.genes)
+        G.add_weighted_edges_from(zip(genes[upper.row], genes[upper.col], upper.data.astype(float)))
         return G
 
     @staticmethod
@@ -299,80 +413,255 @@ class GeneEmbedding(object):
             output.write("{} {}\n".format(gene," ".join(meanv)))
         output.close()
 
+def row_ranges(matrix):
+    # Minimum and span (max - min, 1 for constant rows) of the stored values
+    # of every CSR row.
+    nonempty = numpy.flatnonzero(numpy.diff(matrix.indptr))
+    lower = numpy.zeros(matrix.shape[0])
+    upper = numpy.zeros(matrix.shape[0])
+    if len(nonempty):
+        lower[nonempty] = numpy.minimum.reduceat(matrix.data, matrix.indptr[nonempty])
+        upper[nonempty] = numpy.maximum.reduceat(matrix.data, matrix.indptr[nonempty])
+    span = upper - lower
+    span[span == 0] = 1.0
+    return lower, span
+
+
+def embedding_weights(matrix, rows, n_rows, low=1.0, high=3.0, cells=None):
+    # Expression weights of a cells x genes CSR matrix, each row scaled as
+    # MinMaxScaler(feature_range=(low, high)) on its stored values, with
+    # columns moved onto the embedding rows given by rows (see
+    # GeneEmbedding.rows); genes outside the embedding (-1) are dropped
+    # before scaling, so they do not move a row's range. cells (sorted row
+    # numbers) keeps only those rows. Only the kept entries are copied.
+    matrix = csr_matrix(matrix)
+    row_of = numpy.repeat(numpy.arange(matrix.shape[0]), numpy.diff(matrix.indptr))
+    columns = rows[matrix.indices]
+    keep = columns >= 0
+    if cells is not None:
+        selected = numpy.zeros(matrix.shape[0], dtype=bool)
+        selected[cells] = True
+        keep &= selected[row_of]
+    row_of = row_of[keep]
+    counts = numpy.bincount(row_of, minlength=matrix.shape[0])
+    indptr = numpy.concatenate([[0], numpy.cumsum(counts)])
+    weights = csr_matrix((matrix.data[keep].astype(numpy.float64), columns[keep], indptr), shape=(matrix.shape[0], n_rows))
+    lower, span = row_ranges(weights)
+    weights.data = (weights.data - lower[row_of]) * ((high - low) / span[row_of]) + low
+    if cells is not None:
+        weights = weights[cells]
+    return weights
+
+
+def adata_genes(adata):
+    genes = []
+    for gene in adata.var.index:
+        if isinstance(gene, bytes):
+            gene = gene.decode("utf-8")
+        genes.append(gene.upper())
+    return genes
+
+
+def weighted_vectors(weights, vectors):
+    totals = numpy.asarray(weights.sum(axis=1)).ravel()
+    totals[totals == 0] = 1.0
+    matrix = numpy.asarray(weights @ vectors) / totals[:, None]
+    return numpy.ascontiguousarray(matrix, dtype=numpy.float32)
+
+
+class GroupIndex(object):
+    # label -> rows index. The rows of each group are stored contiguously in
+    # order, group g spanning order[offsets[g]:offsets[g + 1]], so means and
+    # medians are reductions over segments of one gathered matrix.
+
+    def __init__(self, names, order, offsets):
+        self.names = list(names)
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def from_labels(index_class, labels):
+        # One group per distinct label, in order of first appearance. Missing
+        # labels (None/NaN) form a group of their own instead of the -1 code
+        # factorize gives them by default.
+        if "use_na_sentinel" in inspect.signature(pandas.factorize).parameters:
+            options = dict(use_na_sentinel=False)
+        else:
+            options = dict(na_sentinel=None)
+        codes, names = pandas.factorize(numpy.asarray(labels, dtype=object), **options)
+        order = numpy.argsort(codes, kind="stable")
+        offsets = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(codes, minlength=len(names)))])
+        return index_class(names, order, offsets)
+
+    @classmethod
+    def from_sets(index_class, sets, index):
+        # Possibly overlapping groups: sets maps a name to members, looked up
+        # in index (member -> row); unknown and repeated members are dropped.
+        rows = [numpy.unique([index[m] for m in members if m in index]).astype(numpy.int64) for members in sets.values()]
+        offsets = numpy.concatenate([[0], numpy.cumsum([len(r) for r in rows])]).astype(numpy.int64)
+        order = numpy.concatenate(rows) if rows else numpy.zeros(0, dtype=numpy.int64)
+        return index_class(sets.keys(), order, offsets)
+
+    def __len__(self):
+        return len(self.names)
+
+    def counts(self):
+        return numpy.diff(self.offsets)
+
+    def rows(self, group):
+        g = self.names.index(group)
+        return self.order[self.offsets[g]:self.offsets[g + 1]]
+
+    def means(self, matrix):
+        gathered = numpy.asarray(matrix)[self.order]
+        counts = self.counts()
+        means = numpy.full((len(self), gathered.shape[1]), numpy.nan)
+        nonempty = counts > 0
+        if nonempty.any():
+            sums = numpy.add.reduceat(gathered, self.offsets[:-1][nonempty], axis=0, dtype=numpy.float64)
+            means[nonempty] = sums / counts[nonempty, numpy.newaxis]
+        return means
+
+    def medians(self, matrix):
+        gathered = numpy.asarray(matrix)[self.order]
+        medians = numpy.full((len(self), gathered.shape[1]), numpy.nan)
+        for g, (start, end) in enumerate(zip(self.offsets[:-1], self.offsets[1:])):
+            if end > start:
+                medians[g] = numpy.median(gathered[start:end], axis=0)
+        return medians
+
+    def reduce(self, matrix, statistic="median"):
+        if statistic == "median":
+            return self.medians(matrix)
+        if statistic == "mean":
+            return self.means(matrix)
+        raise ValueError("Unknown statistic {}.".format(statistic))
+
+
+class _CellVectorsView(collections.abc.Mapping):
+    # Barcode -> stack of the embedding vectors of the genes expressed in
+    # that cell, built on access rather than held for every cell.
+
+    def __init__(self, cells, weights, vectors):
+        self.cells = cells
+        self.cell_index = {cell: i for i, cell in enumerate(cells)}
+        self.weights = weights
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __iter__(self):
+        return iter(self.cells)
+
+    def __getitem__(self, cell):
+        row = self.cell_index[cell]
+        return self.vectors[self.weights.indices[self.weights.indptr[row]:self.weights.indptr[row + 1]]]
+
+
 class CellEmbedding(object):
 
-    def __init__(self, dataset, embed):
+    def __init__(self, dataset, embed, keep_vectors=False):
         self.context = dataset.data
-        cell_to_gene = list(self.context.cell_to_gene.items())
         self.embed = embed
         self.expression = self.context.expression
-        self.data = collections.defaultdict(list)
-        self.weights = collections.defaultdict(list)
         self.pcs = dict()
-        embed_genes = list(embed.embeddings.keys())
-        self.matrix = []
-
-        for cell, genes in tqdm.tqdm(cell_to_gene):
-            cell_weights = self.expression[cell]
-            cell_genes = []
-            weights = []
-            for g,w in cell_weights.items():
-                if w != 0.0:
-                    cell_genes.append(g)
-                    weights.append(w)
-            weights = numpy.array(weights)
-            scaler = MinMaxScaler(feature_range=(1.0,3.0))
-            scaled_weights = scaler.fit_transform(numpy.array(weights).reshape(-1,1))
-            scaled_weights = list(scaled_weights.reshape(1,-1)[0])
-            vectors = numpy.array([embed.embeddings[gene] for gene in cell_genes])
-            self.matrix.append(numpy.average(vectors,axis=0,weights=scaled_weights))
-            self.data[cell] = vectors
-        self.dataset_vector = numpy.zeros(numpy.array(self.matrix).shape[1])
-
-    def batch_correct(self, column=None, resolution=1, atten=1.0):
+        matrix = self.context.matrix
+        # Cells with at least one expressed gene, counted on the stored
+        # column indices without slicing the matrix.
+        expressed = numpy.zeros(matrix.shape[0], dtype=numpy.int64)
+        nonempty = numpy.flatnonzero(numpy.diff(matrix.indptr))
+        if len(nonempty):
+            expressed[nonempty] = numpy.add.reduceat(self.context.expressed_mask[matrix.indices], matrix.indptr[nonempty], dtype=numpy.int64)
+        rows = numpy.flatnonzero(expressed)
+        self.cells = [self.context.index_cell[row] for row in rows]
+        # Per-cell annotations in the order of self.cells; cells added by
+        # transform(append=True) bring their own obs and AnnData.
+        self.obs = self.context.metadata.iloc[rows]
+        self.appended = []
+        self.weights = embedding_weights(matrix, embed.rows(self.context.genes), len(embed.genes), cells=rows)
+        self.matrix = weighted_vectors(self.weights, embed.matrix)
+        self.data = _CellVectorsView(self.cells, self.weights, embed.matrix)
+        if keep_vectors:
+            self.data = dict(self.data.items())
+        self.dataset_vector = numpy.zeros(self.matrix.shape[1])
+
+    @staticmethod
+    def stream(adata, embed, path, chunk_size=10000):
+        # Out-of-core cell vectors for a (possibly backed) AnnData: X is read
+        # chunk_size rows at a time and each block of vectors is written into
+        # a float32 .npy memmap at path. Rows are computed exactly as in the
+        # in-memory constructor, so every cell it embeds gets a bit-identical
+        # vector; cells without embedded genes are left as zeros.
+        rows = embed.rows(adata_genes(adata))
+        n_cells = adata.shape[0]
+        output = numpy.lib.format.open_memmap(path, mode="w+", dtype=numpy.float32,
+                                              shape=(n_cells, embed.matrix.shape[1]))
+        for start in tqdm.tqdm(range(0, n_cells, chunk_size)):
+            end = min(start + chunk_size, n_cells)
+            chunk = Context.positive_matrix(adata.X[start:end])
+            weights = embedding_weights(chunk, rows, len(embed.genes))
+            output[start:end] = weighted_vectors(weights, embed.matrix)
+            output.flush()
+        return output
+
+    def transform(self, adata, index=None, append=False, key="X_genevector"):
+        # Projects new cells onto the gene embedding and stores the vectors in
+        # adata.obsm[key]. index (a VectorIndex) is extended with them; with
+        # append=True they are also added to this embedding (and to the
+        # AnnData from get_adata, if one was made).
+        weights = embedding_weights(Context.positive_matrix(adata.X), self.embed.rows(adata_genes(adata)), len(self.embed.genes))
+        vectors = weighted_vectors(weights, self.embed.matrix)
+        adata.obsm[key] = vectors
+        cells = list(adata.obs.index)
+        if index is not None:
+            index.add(vectors, labels=cells)
+        if append:
+            self.cells = self.cells + cells
+            self.obs = pandas.concat([self.obs, adata.obs])
+            self.appended.append(adata)
+            self.weights = scipy.sparse.vstack([self.weights, weights], format="csr")
+            self.matrix = numpy.concatenate([self.matrix, vectors])
+            if isinstance(self.data, _CellVectorsView):
+                self.data = _CellVectorsView(self.cells, self.weights, self.embed.matrix)
+            else:
+                self.data.update(_CellVectorsView(cells, weights, self.embed.matrix).items())
+            if getattr(self, "adata", None) is not None:
+                self.adata = anndata.concat([self.adata, adata], merge="same")
+        return vectors
+
+    def batch_correct(self, column=None, resolution=1, atten=1.0, clusters=None):
+        # Shifts every batch onto the first batch seen: each cell gets
+        # atten * (mean of the base batch - mean of its own batch). With
+        # clusters (a label per cell, or True for self.clusters) the means and
+        # the base batch are taken separately within each cluster.
         if not column:
             raise ValueError("Must supply batch label to correct.")
-        _clusters = []
-        for cluster in self.matrix:
-            _clusters.append("C1")
-        self.clusters = _clusters
-        column_labels = dict(zip(self.context.cells, self.context.metadata[column]))
-        labels = []
-        for key in self.data.keys():
-            labels.append(column_labels[key])
-        local_correction = collections.defaultdict(lambda : collections.defaultdict(list))
-        correction_vectors = collections.defaultdict(dict)
-        for cluster, batch, vec in zip(self.clusters, labels, self.matrix):
-            local_correction[cluster][batch].append(vec)
-        for cluster, batches in local_correction.items():
-            cluster_vec = []
-            batch_keys = list(batches.keys())
-            base_batch = batch_keys.pop(0)
-            max_distance = 1.0
-            cluster_vec = numpy.average(batches[base_batch], axis=0)
-            for batch in batch_keys:
-                bvec = list(numpy.average(batches[batch], axis=0))
-                distance = float(cosine_similarity(numpy.array(bvec).reshape(1, -1),numpy.array(cluster_vec).reshape(1, -1))[0])
-                offset = numpy.subtract(cluster_vec,bvec)
-                bvec = numpy.add(bvec,offset)
-                distance = float(cosine_similarity(numpy.array(bvec).reshape(1, -1),numpy.array(cluster_vec).reshape(1, -1))[0])
-                correction_vectors[cluster][batch] = offset
-
-        self.matrix = []
-        self.sample_vector = collections.defaultdict(list)
-        i = 0
-        self.cell_order = []
-        for cell, vectors in self.data.items():
-            cluster = self.clusters[i]
-            xvec = list(numpy.average(vectors, axis=0))
-            batch = column_labels[cell]
-            if cluster in correction_vectors and batch in correction_vectors[cluster]:
-                offset = correction_vectors[cluster][batch]
-                offset = numpy.multiply(offset,atten)
-                xvec = numpy.add(xvec,offset)
-            self.matrix.append(xvec)
-            self.cell_order.append(cell)
-            i += 1
+        if clusters is None:
+            clusters = ["C1"] * len(self.cells)
+        elif clusters is True:
+            clusters = self.clusters
+        if len(clusters) != len(self.cells):
+            raise ValueError("Need one cluster label per cell.")
+        self.clusters = list(clusters)
+        _, cluster_index = numpy.unique(numpy.asarray(self.clusters, dtype=str), return_inverse=True)
+        batch_names, batch_index = numpy.unique(numpy.asarray(self.obs[column], dtype=str), return_inverse=True)
+        n_clusters = cluster_index.max() + 1 if len(cluster_index) else 0
+        groups = cluster_index * len(batch_names) + batch_index
+        n_groups = n_clusters * len(batch_names)
+        indicator = csr_matrix((numpy.ones(len(groups), dtype=numpy.float32), (groups, numpy.arange(len(groups)))),
+                               shape=(n_groups, len(groups)))
+        matrix = numpy.array(self.matrix, dtype=numpy.float32, order="C")
+        counts = numpy.maximum(indicator.getnnz(axis=1), 1).astype(numpy.float32)
+        means = numpy.asarray(indicator @ matrix) / counts[:, numpy.newaxis]
+        _, first = numpy.unique(cluster_index, return_index=True)
+        base = numpy.zeros(n_clusters, dtype=numpy.int64)
+        base[cluster_index[first]] = groups[first]
+        offsets = means[base[numpy.arange(n_groups) // len(batch_names)]] - means
+        offsets *= atten
+        matrix += offsets[groups]
+        self.matrix = matrix
+        self.cell_order = list(self.cells)
 
     def cluster(self, k=12):
         kmeans = KMeans(n_clusters=k)
@@ -385,41 +674,25 @@ class CellEmbedding(object):
         return _clusters
 
     def get_predictive_genes(self, adata, label, n_genes=10):
-        vectors = dict()
-        mapped_components = dict(zip(list(self.data.keys()),self.matrix))
-        comps = collections.defaultdict(list)
-        for bc,x in zip(adata.obs.index,adata.obs[label]):
-            comps[x].append(mapped_components[bc])
-        mean_vecs = []
-        for x, vec in comps.items():
-            ovecs = []
-            vec = numpy.average(vec,axis=0)
-            for oph, ovec in comps.items():
-                ovecs.append(numpy.average(ovec,axis=0))
-            aovec = numpy.median(ovecs,axis=0)
-            vector = numpy.subtract(vec,aovec)
-            vector = numpy.subtract(vector,self.dataset_vector)
-            vectors[x] = vector
-        markers = dict()
-        for x, mvec in vectors.items():
-            ct_sig = self.embed.get_similar_genes(mvec)[:n_genes]["Gene"].tolist()
-            markers[x] = ct_sig
-        return markers
-
-    def cluster_definitions(self):
+        # Each label's mean cell vector, less the median over labels, ranked
+        # against all genes in one similarity product.
+        cell_index = {cell: i for i, cell in enumerate(self.cells)}
+        rows = numpy.array([cell_index[bc] for bc in adata.obs.index], dtype=numpy.int64)
+        groups = GroupIndex.from_labels(adata.obs[label])
+        means = groups.means(self.matrix[rows])
+        vectors = means - numpy.median(means, axis=0) - self.dataset_vector
+        genes, _ = self.embed.most_similar(vectors, k=n_genes)
+        return {x: list(top) for x, top in zip(groups.names, genes)}
+
+    def cluster_definitions(self, k=None):
+        # Genes ranked by cosine similarity to each cluster's mean cell
+        # vector; all genes unless k is given.
+        groups = GroupIndex.from_labels(self.clusters)
+        genes, scores = self.embed.most_similar(groups.means(self.matrix), k=k or len(self.embed.genes))
         gene_similarities = dict()
-        vectors = collections.defaultdict(list)
-        for vec, label in zip(self.matrix, self.clusters):
-            vectors[label].append(vec)
-        for label, vecs in vectors.items():
-            distances = dict()
-            cell_vector = list(numpy.mean(vecs, axis=0))
-            for gene, vector in self.embed.embeddings.items():
-                distance = float(cosine_similarity(numpy.array(cell_vector).reshape(1, -1),numpy.array(vector).reshape(1, -1))[0])
-                distances[gene] = distance
-            sorted_distances = list(reversed(sorted(distances.items(), key=operator.itemgetter(1))))
-            gene_similarities[label] = [x[0] for x in sorted_distances]
-            print(label, sorted_distances[:10])
+        for label, top, score in zip(groups.names, genes, scores):
+            gene_similarities[label] = list(top)
+            print(label, list(zip(top[:10], score[:10])))
         return gene_similarities
 
     def cluster_definitions_as_df(self, similarities, top_n=20):
@@ -478,10 +751,7 @@ class CellEmbedding(object):
 
     def plot(self, png=None, pcs=None, method="TSNE", column=None):
         if column:
-            column_labels = dict(zip(self.context.cells,self.context.metadata[column]))
-            labels = []
-            for key in self.data.keys():
-                labels.append(column_labels[key])
+            labels = list(self.obs[column])
         else:
             labels = self.clusters
         plt.figure(figsize = (8, 8))
@@ -533,74 +803,31 @@ class CellEmbedding(object):
     def phenotype_probability(self, adata, phenotype_markers, target_col="genevector", method="softmax"):
         from sklearn.preprocessing import StandardScaler, MinMaxScaler
         from scipy.special import softmax
-        from scipy.spatial import distance
-        import numpy
-        import tqdm
-        mapped_components = dict(zip(list(self.data.keys()),self.matrix))
-        adata = adata[list(self.data.keys())]
-        probs = dict()
-        for pheno, markers in phenotype_markers.items():
-            dists = []
-            vector = self.embed.generate_vector(markers)
-            ovecs = []
-            for oph, ovec in phenotype_markers.items():
-                ovec = self.embed.generate_vector(ovec)
-                ovecs.append(ovec)
-            aovec = numpy.median(ovecs,axis=0)
-            vector = numpy.subtract(vector,aovec)
-            for x in tqdm.tqdm(adata.obs.index):
-                dist = 1.0 - distance.cosine(mapped_components[x],vector)
-                dists.append(dist)
-            probs[pheno] = dists
-        distribution = []
-        celltypes = []
-        for k, v in probs.items():
-            distribution.append(v)
-            celltypes.append(k)
-        distribution = list(zip(*distribution))
-        classif = []
-        probabilities = []
-        if method=="normalized":
-            scaler = MinMaxScaler()
-            res = scaler.fit_transform(numpy.array(distribution))
-            for ct in res:
-                ct = ct / ct.sum()
-                probabilities.append(ct)
-                assign = celltypes[numpy.argmax(ct)]
-                classif.append(assign)
-        if method=="softmax":
-            scaler = StandardScaler()
-            probabilities = softmax(scaler.fit_transform(numpy.array(distribution)),axis=1)
-            for ct in probabilities:
-                assign = celltypes[numpy.argmax(ct)]
-                classif.append(assign)
-        umap_pts = dict(zip(list(self.data.keys()),classif))
-        res = {"distances":distribution, "order":celltypes, "probabilities":probabilities}
-        barcode_to_label = dict(zip(list(self.data.keys()), res["probabilities"]))
-        ct = []
-        probs = collections.defaultdict(list)
-        for x in adata.obs.index:
-            ctx = res["order"][numpy.argmax(barcode_to_label[x])]
-            ct.append(ctx)
-            for ph, pb in zip(res["order"],barcode_to_label[x]):
-                probs[ph].append(pb)
-        adata.obs[target_col] = ct
-        def load_predictions(adata,probs):
-            for ph in probs.keys():
-                print(ph)
-                adata.obs[ph+" Pseudo-probability"] = probs[ph]
-            return adata
-        adata = load_predictions(adata,probs)
+        adata = adata[self.cells]
+        celltypes = list(phenotype_markers.keys())
+        # One marker vector per phenotype, centred on their median, and the
+        # cosine of every cell with every phenotype in a single product.
+        vectors = numpy.array([self.embed.generate_vector(markers) for markers in phenotype_markers.values()])
+        vectors -= numpy.median(vectors, axis=0)
+        distribution = GeneEmbedding.normalize(self.matrix) @ GeneEmbedding.normalize(vectors).T
+        if method == "normalized":
+            probabilities = MinMaxScaler().fit_transform(distribution)
+            probabilities /= probabilities.sum(axis=1, keepdims=True)
+        elif method == "softmax":
+            probabilities = softmax(StandardScaler().fit_transform(distribution), axis=1)
+        else:
+            raise ValueError("Unknown method {}.".format(method))
+        adata.obs[target_col] = numpy.array(celltypes, dtype=object)[numpy.argmax(probabilities, axis=1)]
+        for i, ph in enumerate(celltypes):
+            adata.obs[ph+" Pseudo-probability"] = probabilities[:, i]
         return adata
 
     def get_adata(self, min_dist=0.3, n_neighbors=50):
-        adata = self.context.adata.copy()
-        adata = adata[list(self.data.keys())]
-        mapped_components = dict(zip(list(self.data.keys()),self.matrix))
-        x_genevector = []
-        for x in adata.obs.index:
-            x_genevector.append(mapped_components[x])
-        adata.obsm['X_genevector'] = numpy.array(x_genevector)
+        n_context = len(self.cells) - sum(a.shape[0] for a in self.appended)
+        adata = self.context.adata[self.cells[:n_context]].copy()
+        if self.appended:
+            adata = anndata.concat([adata] + self.appended, merge="same")
+        adata.obsm['X_genevector'] = numpy.array(self.matrix)
         sc.pp.neighbors(adata, use_rep="X_genevector", n_neighbors=n_neighbors)
         sc.tl.umap(adata, min_dist=min_dist)
         self.adata = adata
@@ -635,19 +862,9 @@ class CellEmbedding(object):
             sns.heatmap(cm, annot=annot, fmt='', ax=ax)
         plot_cm(gv,gt)
 
-    def group_cell_vectors(self, label):
-        barcode_to_label = dict(zip(self.context.adata.obs.index.tolist(),self.context.adata.obs[label]))
-        label_vector = dict()
-        labels = []
-        for cell, vectors in self.data.items():
-            vector = list(numpy.median(vectors, axis=0))
-            labels.append(barcode_to_label[cell])
-            label_vector[barcode_to_label[cell]] = vector
-        for cell, vectors in self.data.items():
-            _vectors = []
-            for vector in vectors:
-                _vectors.append(numpy.subtract(vector, label_vector[barcode_to_label[cell]]))
-            vectors = _vectors
-            vector = list(numpy.median(vectors, axis=0))
-            label_vector[barcode_to_label[cell]] = vector
+    def group_cell_vectors(self, label, statistic="median"):
+        # Median (or mean) cell vector for every value of obs[label].
+        labels = list(self.obs[label])
+        groups = GroupIndex.from_labels(labels)
+        label_vector = dict(zip(groups.names, groups.reduce(self.matrix, statistic)))
         return label_vector, labels
@@ -0,0 +1,167 @@
+import time
+
+import numpy
+from scipy.sparse import csr_matrix
+
+from genevector.vectors import normalize
+from genevector.storage import write_directory, read_header, read_array, has_array, read_entry
+
+INDEX_VERSION = 1
+
+
+def _nearest(matrix, centroids, chunk_size=65536):
+    assignment = numpy.empty(len(matrix), dtype=numpy.int64)
+    for start in range(0, len(matrix), chunk_size):
+        block = matrix[start:start + chunk_size]
+        assignment[start:start + len(block)] = numpy.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+
+def spherical_kmeans(matrix, n_clusters, n_iter=10, seed=0):
+    rng = numpy.random.default_rng(seed)
+    centroids = matrix[rng.choice(len(matrix), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = _nearest(matrix, centroids)
+        members = csr_matrix((numpy.ones(len(matrix), dtype=numpy.float32), (assignment, numpy.arange(len(matrix)))),
+                             shape=(n_clusters, len(matrix)))
+        sums = numpy.asarray(members @ matrix)
+        empty = numpy.flatnonzero(members.getnnz(axis=1) == 0)
+        sums[empty] = matrix[rng.choice(len(matrix), len(empty), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+class VectorIndex(object):
+    # Inverted-file (IVF) index for cosine similarity. Vectors are
+    # L2-normalized, partitioned by spherical k-means into nlist lists and
+    # stored contiguously per list; a query scans only the nprobe lists
+    # whose centroids are most similar to it.
+
+    def __init__(self, centroids, vectors, ids, offsets, labels=None, nprobe=16):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.labels = labels
+        self.nprobe = nprobe
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(index_class, matrix, labels=None, nlist=None, nprobe=16, n_iter=10, sample_size=100000, seed=0):
+        matrix = normalize(matrix)
+        if nlist is None:
+            nlist = int(4 * numpy.sqrt(len(matrix)))
+        nlist = max(1, min(nlist, len(matrix)))
+        rng = numpy.random.default_rng(seed)
+        sample = matrix
+        if len(matrix) > sample_size:
+            sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+        centroids = spherical_kmeans(sample, nlist, n_iter=n_iter, seed=seed)
+        assignment = _nearest(matrix, centroids)
+        ids = numpy.argsort(assignment, kind="stable")
+        offsets = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(assignment, minlength=nlist))])
+        if labels is not None:
+            labels = numpy.asarray(labels, dtype=str)
+        return index_class(centroids, numpy.ascontiguousarray(matrix[ids]), ids, offsets, labels=labels, nprobe=nprobe)
+
+    @classmethod
+    def from_gene_embedding(index_class, embed, **kwargs):
+        return index_class.build(embed.matrix, labels=embed.genes, **kwargs)
+
+    @classmethod
+    def from_cell_embedding(index_class, embed, **kwargs):
+        return index_class.build(embed.matrix, labels=list(embed.data.keys()), **kwargs)
+
+    def add(self, matrix, labels=None):
+        # New vectors join the list of their nearest centroid; their ids
+        # continue after the rows already indexed.
+        if self.labels is not None and (labels is None or len(labels) != len(matrix)):
+            raise ValueError("This index is labelled; pass one label per added vector.")
+        matrix = normalize(matrix)
+        lists = numpy.repeat(numpy.arange(len(self.centroids)), numpy.diff(self.offsets))
+        lists = numpy.concatenate([lists, _nearest(matrix, self.centroids)])
+        ids = numpy.concatenate([self.ids, numpy.arange(len(self.ids), len(self.ids) + len(matrix))])
+        order = numpy.argsort(lists, kind="stable")
+        self.vectors = numpy.ascontiguousarray(numpy.concatenate([self.vectors, matrix])[order])
+        self.ids = ids[order]
+        self.offsets = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(lists, minlength=len(self.centroids)))])
+        if self.labels is not None:
+            self.labels = numpy.concatenate([self.labels, numpy.asarray(labels, dtype=str)])
+
+    def query(self, queries, k=10, nprobe=None):
+        # Returns (queries x k) row indices into the indexed matrix and their
+        # cosine similarities, best first; rows are -1 when fewer than k
+        # candidates were scanned.
+        queries = normalize(numpy.atleast_2d(queries))
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes = numpy.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        rows = numpy.full((len(queries), k), -1, dtype=numpy.int64)
+        scores = numpy.full((len(queries), k), -numpy.inf, dtype=numpy.float32)
+        for q, (query, probe) in enumerate(zip(queries, probes)):
+            candidates = numpy.concatenate([numpy.arange(self.offsets[l], self.offsets[l + 1]) for l in probe])
+            similarities = self.vectors[candidates] @ query
+            n = min(k, len(candidates))
+            if n == 0:
+                continue
+            top = numpy.argpartition(-similarities, n - 1)[:n]
+            top = top[numpy.argsort(-similarities[top], kind="stable")]
+            rows[q, :n] = self.ids[candidates[top]]
+            scores[q, :n] = similarities[top]
+        return rows, scores
+
+    def query_labels(self, queries, k=10, nprobe=None):
+        # Missing results (row -1) come back as None.
+        rows, scores = self.query(queries, k=k, nprobe=nprobe)
+        labels = numpy.asarray(self.labels, dtype=object)[rows]
+        labels[rows < 0] = None
+        return labels, scores
+
+    def exact(self, queries, k=10):
+        queries = normalize(numpy.atleast_2d(queries))
+        similarities = queries @ self.vectors.T
+        k = min(k, similarities.shape[1])
+        top = numpy.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        order = numpy.argsort(-numpy.take_along_axis(similarities, top, axis=1), axis=1, kind="stable")
+        top = numpy.take_along_axis(top, order, axis=1)
+        return self.ids[top], numpy.take_along_axis(similarities, top, axis=1)
+
+    def recall(self, queries, k=10, nprobe=None):
+        # Mean recall@k of query() against exact brute-force search.
+        approximate, _ = self.query(queries, k=k, nprobe=nprobe)
+        exact, _ = self.exact(queries, k=k)
+        hits = [len(set(a) & set(e)) for a, e in zip(approximate, exact)]
+        return float(numpy.mean(hits)) / k
+
+    def save(self, path):
+        arrays = {"centroids": self.centroids, "vectors": self.vectors, "ids": self.ids, "offsets": self.offsets}
+        if self.labels is not None:
+            arrays["labels"] = self.labels
+        header = {"format": "genevector.index", "version": INDEX_VERSION, "metric": "cosine", "nprobe": self.nprobe}
+        write_directory(path, arrays, header_file="index.json", header=header)
+
+    @classmethod
+    def load(index_class, path, mmap_mode="r"):
+        return read_entry(path, lambda version: index_class.load_version(version, mmap_mode))
+
+    @classmethod
+    def load_version(index_class, path, mmap_mode):
+        header = read_header(path, "index.json", "genevector.index", INDEX_VERSION)
+        load = lambda name: read_array(path, name, mmap_mode=mmap_mode)
+        labels = load("labels") if has_array(path, "labels") else None
+        return index_class(numpy.asarray(load("centroids")), load("vectors"), load("ids"), numpy.asarray(load("offsets")),
+                           labels=labels, nprobe=header["nprobe"])
+
+
+def benchmark(index, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32)):
+    results = []
+    for nprobe in nprobes:
+        start = time.time()
+        index.query(queries, k=k, nprobe=nprobe)
+        latency = (time.time() - start) / len(queries)
+        results.append({"nprobe": nprobe, "recall": index.recall(queries, k=k, nprobe=nprobe), "latency": latency})
+    start = time.time()
+    index.exact(queries, k=k)
+    results.append({"nprobe": "exact", "recall": 1.0, "latency": (time.time() - start) / len(queries)})
+    return results
@@ -9,88 +9,311 @@ import scanpy as sc
 from torch.autograd import Variable
 
 import torch as t
+import torch.distributed as dist
 import numpy as np
+import collections
+import contextlib
+import inspect
+import os
+import random
+import tempfile
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.nn.init import xavier_normal
 
-def mse_loss(inputs, targets, device):
-    loss = F.mse_loss(inputs, targets, reduction='none')
-    if device == "cuda":
-        loss = loss.cuda()
-    return torch.mean(loss).to(device)
+from genevector.vectors import write_vectors, write_text
+
+def mse_loss(inputs, targets, device=None):
+    # device is unused; it is kept so existing three-argument calls work.
+    return F.mse_loss(inputs, targets.to(inputs.dtype))
+
+
+def compile_model(model):
+    # torch.compile fuses the lookup, product and sum of forward(); older
+    # PyTorch falls back to TorchScript, then to eager.
+    if hasattr(torch, "compile"):
+        return torch.compile(model)
+    try:
+        return torch.jit.script(model)
+    except Exception:
+        return model
+
+
+def stochastic_round(x, dtype):
+    # Rounds float32 x to bfloat16/float16 up or down with probability given
+    # by the distance, so updates smaller than half a step survive on average.
+    if dtype == torch.float32:
+        return x
+    if dtype == torch.bfloat16:
+        # bfloat16 is the top half of float32: add noise below it, truncate.
+        bits = x.contiguous().view(torch.int32)
+        noise = torch.randint(0, 1 << 16, x.shape, dtype=torch.int32, device=x.device)
+        return ((bits + noise) & -65536).view(torch.float32).to(dtype)
+    nearest = x.to(dtype)
+    error = x - nearest.float()
+    other = torch.nextafter(nearest, torch.where(error > 0, float("inf"), float("-inf")).to(dtype))
+    step = other.float() - nearest.float()
+    return torch.where(torch.rand_like(x) * step.abs() < error.abs(), other, nearest)
+
+
+class LowPrecisionAdagrad(object):
+    # Adagrad for bfloat16/float16 tables without a float32 copy of the
+    # weights. A step reads the rows it touches in float32 (dense gradients
+    # in blocks of rows), updates them and writes them back stochastically
+    # rounded. The squared-gradient sums have the table's dtype for bfloat16
+    # and are float32 for float16, whose range cannot hold them.
+
+    def __init__(self, params, lr=0.01, eps=1e-10, block_size=4096):
+        self.params = list(params)
+        self.lr = lr
+        self.eps = eps
+        self.block_size = block_size
+        self.state_sums = [torch.zeros_like(p, dtype=torch.bfloat16 if p.dtype == torch.bfloat16 else torch.float32)
+                           for p in self.params]
+
+    def zero_grad(self, set_to_none=True):
+        for p in self.params:
+            p.grad = None
+
+    def update(self, p, state, rows, grad):
+        values = grad.float()
+        sums = state[rows].float() + values * values
+        state[rows] = stochastic_round(sums, state.dtype)
+        weights = p[rows].float() - self.lr * values / (sums.sqrt() + self.eps)
+        p[rows] = stochastic_round(weights, p.dtype)
+
+    @torch.no_grad()
+    def step(self):
+        for p, state in zip(self.params, self.state_sums):
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                grad = p.grad.coalesce()
+                self.update(p, state, grad.indices()[0], grad.values())
+            else:
+                for start in range(0, len(p), self.block_size):
+                    rows = slice(start, start + self.block_size)
+                    self.update(p, state, rows, p.grad[rows])
+
+    def state_dict(self):
+        return {"lr": self.lr, "eps": self.eps, "state_sums": [state.clone() for state in self.state_sums]}
+
+    def load_state_dict(self, state):
+        self.lr = state["lr"]
+        self.eps = state["eps"]
+        for current, saved in zip(self.state_sums, state["state_sums"]):
+            current.copy_(saved)
+
+
+def build_optimizer(model, name, lr):
+    if name not in ("adagrad", "sparse_adam"):
+        raise ValueError("Unknown optimizer {}.".format(name))
+    if model.dtype != torch.float32:
+        if name != "adagrad":
+            raise ValueError("bfloat16/float16 tables are trained with adagrad.")
+        return LowPrecisionAdagrad(model.parameters(), lr=lr)
+    # Adagrad accepts dense and sparse gradients; SparseAdam only sparse ones.
+    if name == "adagrad":
+        return optim.Adagrad(model.parameters(), lr=lr)
+    if not model.sparse:
+        raise ValueError("sparse_adam requires sparse_gradients=True.")
+    return optim.SparseAdam(list(model.parameters()), lr=lr)
 
 
 class GeneVectorModel(nn.Module):
-    def __init__(self, num_embeddings, embedding_dim):
+    def __init__(self, num_embeddings, embedding_dim, sparse=False, bias=False, dtype=torch.float32):
         self.num_embeddings = num_embeddings
         self.embedding_dim = embedding_dim
+        self.sparse = sparse
+        self.bias = bias
+        self.dtype = dtype
         super(GeneVectorModel, self).__init__()
-        self.wi = nn.Embedding(num_embeddings, embedding_dim)
-        self.wj = nn.Embedding(num_embeddings, embedding_dim)
+        # With sparse=True a step only produces gradients (and optimizer
+        # updates) for the rows in the batch.
+        self.wi = nn.Embedding(num_embeddings, embedding_dim, sparse=sparse)
+        self.wj = nn.Embedding(num_embeddings, embedding_dim, sparse=sparse)
         self.wi.weight.data.uniform_(-1., 1.)
         self.wj.weight.data.uniform_(-1., 1.)
+        if bias:
+            # Per-gene biases as in GloVe.
+            self.bi = nn.Embedding(num_embeddings, 1, sparse=sparse)
+            self.bj = nn.Embedding(num_embeddings, 1, sparse=sparse)
+            self.bi.weight.data.zero_()
+            self.bj.weight.data.zero_()
+        # Tables may be stored in bfloat16/float16; rows are upcast after the
+        # lookup so products and the loss are float32.
+        self.to(dtype)
 
     def forward(self, i_indices, j_indices):
-        w_i = self.wi(i_indices)
-        w_j = self.wj(j_indices)
+        w_i = self.wi(i_indices).float()
+        w_j = self.wj(j_indices).float()
         x = torch.sum(w_i * w_j, dim=1)
+        if self.bias:
+            x = x + self.bi(i_indices).float().squeeze(1) + self.bj(j_indices).float().squeeze(1)
         return x
 
-    def save_embedding(self, id2word, file_name, layer):
+    def save_embedding(self, id2word, file_name, layer, binary=True):
         if layer == 0:
-            embedding = self.wi.weight.cpu().data.numpy()
+            embedding = self.wi.weight.cpu().data.float().numpy()
+        else:
+            embedding = self.wj.weight.cpu().data.float().numpy()
+        wids = list(id2word.keys())
+        genes = [id2word[wid] for wid in wids]
+        if binary:
+            write_vectors(file_name, genes, embedding[wids])
         else:
-            embedding = self.wj.weight.cpu().data.numpy()
-        with open(file_name, 'w') as f:
-            f.write('%d %d\n' % (len(id2word), self.embedding_dim))
-            for wid, w in id2word.items():
-                e = ' '.join(map(lambda x: str(x), embedding[wid]))
-                f.write('%s %s\n' % (w, e))
+            write_text(file_name, genes, embedding[wids])
 
 class GeneVector(object):
-    def __init__(self, dataset, output_file, emb_dimension=100, batch_size=100000, initial_lr=0.01, device="cpu", threshold=1e-5, scale=1000, max_pct=0.5, min_pct=0.0):
+    def __init__(self, dataset, output_file, emb_dimension=100, batch_size=100000, initial_lr=0.01, device="cpu", threshold=1e-5, scale=1000, max_pct=0.5, min_pct=0.0, sparse=False, negatives=None, cache=None, export_text=False, compile=False, sparse_gradients=False, optimizer="adagrad", bias=False, convergence_window=5, seed=None, index_dtype="int64", target_dtype="float32", embedding_dtype="float32"):
         self.dataset = dataset
-        self.dataset.create_inputs_outputs(scale=scale, max_pct=max_pct, min_pct=min_pct)
+        self.dataset.create_inputs_outputs(scale=scale, max_pct=max_pct, min_pct=min_pct, sparse=sparse, negatives=negatives, cache=cache, index_dtype=index_dtype, target_dtype=target_dtype)
         self.output_file_name = output_file
         self.emb_size = len(self.dataset.data.gene2id)
         self.emb_dimension = emb_dimension
         self.batch_size = batch_size
         self.initial_lr = initial_lr
         self.use_cuda = torch.cuda.is_available()
-        self.model = GeneVectorModel(self.emb_size, self.emb_dimension)
+        if embedding_dtype not in ("float32", "bfloat16", "float16"):
+            raise ValueError("embedding_dtype must be float32, bfloat16 or float16.")
+        self.model = GeneVectorModel(self.emb_size, self.emb_dimension, sparse=sparse_gradients, bias=bias, dtype=getattr(torch, embedding_dtype))
         self.device = device
         if self.device == "cuda" and not self.use_cuda:
             raise ValueError("CUDA requested but no GPU available.")
         elif self.device == "cuda":
             self.model.cuda()
-        self.optimizer = optim.Adagrad(self.model.parameters(), lr=initial_lr)
+        self.optimizer = build_optimizer(self.model, optimizer, initial_lr)
+        self.compile = compile
+        self.forward = compile_model(self.model) if compile else self.model
+        self.ddp = None
         self.epoch = 0
+        self.epoch_losses = []
         self.threshold = threshold
+        self.convergence_window = convergence_window
+        # Epoch permutations and negatives are drawn from (seed, epoch, rank).
+        self.seed = int(np.random.randint(2 ** 31)) if seed is None else seed
+        self.export_text = export_text
 
 
-    def train(self, epochs):
-        n_batches = int(len(self.dataset._xij) / self.batch_size)
-        loss_values = list()
-        for e in range(1, epochs+1):
+    def join(self):
+        # Under DistributedDataParallel ranks may run out of batches at
+        # different steps; join() lets the others finish their all-reduces.
+        if self.ddp is None:
+            return contextlib.nullcontext()
+        return self.ddp.join()
+
+    def convergence_delta(self):
+        # Change in the mean loss over the last convergence_window epochs
+        # from one epoch to the next; None until there are enough epochs.
+        window = self.convergence_window
+        if len(self.epoch_losses) <= window:
+            return None
+        return abs(np.mean(self.epoch_losses[-window - 1:-1]) - np.mean(self.epoch_losses[-window:]))
+
+    def train(self, epochs, checkpoint=None, checkpoint_every=1, resume_from=None):
+        # Runs up to epoch `epochs`. With checkpoint, the training state is
+        # written there every checkpoint_every epochs; resume_from continues
+        # from such a file.
+        distributed = dist.is_available() and dist.is_initialized()
+        rank = dist.get_rank() if distributed else 0
+        main = rank == 0
+        first = 1
+        if resume_from is not None:
+            self.load_checkpoint(resume_from)
+            first = self.epoch + 1
+        n_samples = len(self.dataset._xij)
+        if getattr(self.dataset, "sparse", False):
+            n_samples += self.dataset.negatives
+        n_batches = int(n_samples / self.batch_size)
+        loss_values = collections.deque(maxlen=20)
+        for e in range(first, epochs+1):
             batch_i = 0
-            for x_ij, i_idx, j_idx in self.dataset.get_batches(self.batch_size):
-                batch_i += 1
-                self.optimizer.zero_grad()
-                outputs = self.model(i_idx, j_idx)
-                loss = mse_loss(outputs, x_ij, self.device)
-                loss.backward()
-                self.optimizer.step()
-                loss_values.append(loss.item())
-                if batch_i % 100 == 0:
-                    print("Epoch: {}/{} \t Batch: {}/{} \t Loss: {}".format(e, epochs, batch_i, n_batches, np.mean(loss_values[-20:])))
-            delta = abs(loss_values[-2] -loss_values[-1])
-            print("Epoch",self.epoch, "\tDelta->",delta,"\tLoss:",np.mean(loss_values[-20:]))
-            if delta < self.threshold:
-                print("Training completed.")
+            # Losses stay on the device and are only read back when reported.
+            total = torch.zeros((), device=self.device)
+            seed = np.random.SeedSequence([self.seed, e, rank]).generate_state(1)[0]
+            with self.join():
+                for x_ij, i_idx, j_idx in self.dataset.get_batches(self.batch_size, seed=seed):
+                    batch_i += 1
+                    self.optimizer.zero_grad(set_to_none=True)
+                    outputs = self.forward(i_idx, j_idx)
+                    loss = mse_loss(outputs, x_ij)
+                    loss.backward()
+                    self.optimizer.step()
+                    loss_values.append(loss.detach())
+                    total += loss.detach()
+                    if main and batch_i % 100 == 0:
+                        print("Epoch: {}/{} \t Batch: {}/{} \t Loss: {}".format(e, epochs, batch_i, n_batches, torch.stack(list(loss_values)).mean().item()))
+            epoch_loss = total / max(batch_i, 1)
+            if distributed:
+                # Every rank has to take the same stopping decision.
+                dist.all_reduce(epoch_loss)
+                epoch_loss /= dist.get_world_size()
+            self.epoch_losses.append(epoch_loss.item())
+            self.epoch = e
+            delta = self.convergence_delta()
+            converged = delta is not None and delta < self.threshold
+            if main:
+                print("Epoch",self.epoch, "\tDelta->",delta,"\tLoss:",self.epoch_losses[-1])
+                if checkpoint is not None and (e % checkpoint_every == 0 or converged or e == epochs):
+                    self.save_checkpoint(checkpoint)
+            if converged:
+                if main:
+                    print("Training completed.")
                 break
-            self.epoch += 1
-        print("Saving model...")
-        self.model.save_embedding(self.dataset.data.id2gene, self.output_file_name, 0)
-        self.model.save_embedding(self.dataset.data.id2gene, self.output_file_name.replace(".vec","2.vec"), 1)
+        if main:
+            print("Saving model...")
+            self.save()
+
+    def save_checkpoint(self, path):
+        state = {"model": self.model.state_dict(),
+                 "optimizer": self.optimizer.state_dict(),
+                 "epoch": self.epoch,
+                 "epoch_losses": self.epoch_losses,
+                 "seed": self.seed,
+                 "torch_rng": torch.get_rng_state(),
+                 "numpy_rng": np.random.get_state(),
+                 "python_rng": random.getstate()}
+        if self.device == "cuda":
+            state["cuda_rng"] = torch.cuda.get_rng_state_all()
+        # Written next to the target and renamed over it, so a preempted job
+        # leaves either the previous checkpoint or the new one.
+        fd, staging = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(staging, path)
+        except Exception:
+            os.remove(staging)
+            raise
+
+    def load_checkpoint(self, path):
+        # The checkpoint holds numpy/python RNG state, which newer PyTorch
+        # only unpickles with weights_only=False; older releases lack the flag.
+        # Everything is loaded on the CPU: set_rng_state takes CPU ByteTensors,
+        # and load_state_dict copies model and optimizer state to the device.
+        options = dict(map_location="cpu")
+        if "weights_only" in inspect.signature(torch.load).parameters:
+            options["weights_only"] = False
+        state = torch.load(path, **options)
+        self.model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.epoch = state["epoch"]
+        self.epoch_losses = list(state["epoch_losses"])
+        self.seed = state["seed"]
+        torch.set_rng_state(state["torch_rng"])
+        np.random.set_state(state["numpy_rng"])
+        random.setstate(state["python_rng"])
+        if "cuda_rng" in state:
+            torch.cuda.set_rng_state_all(state["cuda_rng"])
+
+    def save(self):
+        id2gene = self.dataset.data.id2gene
+        secondary = self.output_file_name.replace(".vec","2.vec")
+        self.model.save_embedding(id2gene, self.output_file_name, 0)
+        self.model.save_embedding(id2gene, secondary, 1)
+        if self.export_text:
+            self.model.save_embedding(id2gene, self.output_file_name, 0, binary=False)
+            self.model.save_embedding(id2gene, secondary, 1, binary=False)
@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import tempfile
+import uuid
+
+import numpy
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def resolve(path):
+    # The version directory path currently points to. Readers open every
+    # file through it (see read_entry), so a concurrent replace() cannot mix
+    # two versions.
+    return os.path.realpath(path)
+
+
+def read_entry(path, read, attempts=3):
+    # Returns read(version) for the version path points to. A replace() that
+    # lands between resolving and opening removes that version; the read is
+    # then retried on the new one.
+    for attempt in range(attempts):
+        try:
+            return read(resolve(path))
+        except FileNotFoundError:
+            if attempt == attempts - 1 or not os.path.lexists(path):
+                raise
+
+
+def remove(path):
+    # Removes an entry written by write_directory (the link and the version
+    # it points to) or a plain file or directory.
+    if os.path.islink(path):
+        target = resolve(path)
+        os.remove(path)
+        shutil.rmtree(target, ignore_errors=True)
+    elif os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def replace(staging, path):
+    # Points path at the staging directory. path is a symlink to a hidden
+    # version directory next to it, swapped with one os.replace, so readers
+    # always find either the old or the new version. A plain directory left
+    # by an older release is moved aside first and is the only case with a
+    # moment where path is missing.
+    parent = os.path.dirname(os.path.abspath(path))
+    link = os.path.join(parent, ".tmp-link-" + uuid.uuid4().hex)
+    os.symlink(os.path.basename(staging), link)
+    previous = resolve(path) if os.path.islink(path) else None
+    try:
+        if os.path.lexists(path) and not os.path.islink(path):
+            aside = os.path.join(parent, ".old-" + uuid.uuid4().hex)
+            os.rename(path, aside)
+            previous = aside
+        os.replace(link, path)
+    except Exception:
+        os.remove(link)
+        raise
+    if previous is not None and previous != os.path.abspath(staging):
+        remove(previous)
+
+
+def write_directory(path, arrays, header_file=None, header=None, write=None):
+    # Writes arrays as name.npy files, an optional JSON header and anything
+    # write(staging) adds into a new version directory next to path, then
+    # swaps it into place with replace().
+    name = os.path.basename(os.path.abspath(path))
+    staging = tempfile.mkdtemp(prefix="." + name + "-", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        # mkdtemp creates the directory 0700; give it the usual permissions
+        # so other users and workers can read the saved entry.
+        os.chmod(staging, 0o777 & ~_umask())
+        for array_name, array in arrays.items():
+            numpy.save(os.path.join(staging, array_name + ".npy"), array)
+        if header is not None:
+            with open(os.path.join(staging, header_file), "w") as f:
+                json.dump(header, f)
+        if write is not None:
+            write(staging)
+        replace(staging, path)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def read_header(path, header_file, format, version):
+    with open(os.path.join(path, header_file)) as f:
+        header = json.load(f)
+    if header.get("format") != format or header["version"] > version:
+        raise ValueError("Unsupported {} format in {}.".format(format, path))
+    return header
+
+
+def read_array(path, name, mmap_mode=None):
+    return numpy.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+
+def has_array(path, name):
+    return os.path.exists(os.path.join(path, name + ".npy"))
@@ -0,0 +1,42 @@
+import os
+
+import numpy
+
+
+def vector_paths(file_name):
+    # "genes.vec" -> ("genes.npy", "genes.genes.npy"): a float32 genes x
+    # dimensions matrix and the gene name for each row.
+    base = os.path.splitext(file_name)[0]
+    return base + ".npy", base + ".genes.npy"
+
+
+def normalize(matrix, dtype=numpy.float32):
+    # Rows scaled to unit length; zero rows stay zero.
+    matrix = numpy.asarray(matrix, dtype=dtype)
+    norms = numpy.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def has_vectors(file_name):
+    return all(os.path.exists(path) for path in vector_paths(file_name))
+
+
+def write_vectors(file_name, genes, matrix):
+    matrix_path, genes_path = vector_paths(file_name)
+    numpy.save(matrix_path, numpy.ascontiguousarray(matrix, dtype=numpy.float32))
+    numpy.save(genes_path, numpy.array(genes, dtype=str))
+
+
+def read_vectors(file_name, mmap_mode="r"):
+    matrix_path, genes_path = vector_paths(file_name)
+    genes = numpy.load(genes_path).tolist()
+    matrix = numpy.load(matrix_path, mmap_mode=mmap_mode)
+    return genes, matrix
+
+
+def write_text(file_name, genes, matrix):
+    with open(file_name, "w") as f:
+        f.write('%d %d\n' % matrix.shape)
+        for gene, vector in zip(genes, matrix):
+            f.write('%s %s\n' % (gene, ' '.join(map(str, vector))))
@@ -6,4 +6,5 @@ setup(
     description='Single Cell Gene Vector Library',
     packages=find_packages(include=['genevector']),
     install_requires=["scipy","leidenalg","numpy","notebook","sklearn","cython","pandas","scanpy","umap-learn","tqdm","seaborn","matplotlib"],
+    entry_points={"console_scripts": ["genevector-train=genevector.distributed:main"]},
 )